@@ -113,6 +113,7 @@ if __name__ == "__main__":
     os.environ["APP_CONFIG_FILE"] = args.config
 
     from chatui import api, chat_client, configuration, pages
+    from chatui.utils import indexing, warmup
 
     # load config
     config_file = os.environ.get("APP_CONFIG_FILE", "/dev/null")
@@ -129,4 +130,10 @@ if __name__ == "__main__":
     proxy_prefix = os.environ.get("PROXY_PREFIX")
     blocks = pages.converse.build_page(client)
     blocks.queue(max_size=10)
-    blocks.launch(server_name="0.0.0.0", server_port=8080, root_path=proxy_prefix)
\ No newline at end of file
+
+    # Serve the page next to a /ready check, and warm the models in the background so replicas report ready once warm
+    app = api.create_app(blocks, root_path=proxy_prefix)
+    warmup.start_background_warmup()
+    # Bring the vector indexes of tables that grew past the threshold up to date
+    indexing.schedule_maintenance()
+    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -18,11 +18,12 @@ import os
 
 import gradio as gr
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from chatui.chat_client import ChatClient
 
 from chatui import pages
+from chatui.utils import metrics, warmup
 
 STATIC_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "static")
 
@@ -70,3 +71,28 @@ class APIServer(FastAPI):
             return FileResponse(os.path.join(STATIC_DIR, "kb.html"))
 
         self.mount("/", StaticFiles(directory=STATIC_DIR, html=True))
+
+
+def create_app(blocks: gr.Blocks, root_path: str = None) -> FastAPI:
+    """Serve the chat page at the root, next to a readiness check for load balancers and Prometheus metrics.
+
+    :param blocks: The Gradio page to serve, with its queue already configured.
+    :type blocks: gr.Blocks
+    :param root_path: The proxy prefix the page is served under, if any.
+    :type root_path: str
+    :returns: The application to run.
+    :rtype: FastAPI
+    """
+    app = FastAPI(title=APIServer.title, description=APIServer.desc)
+
+    @app.get("/ready")
+    async def ready() -> JSONResponse:
+        is_ready, report = warmup.readiness()
+        return JSONResponse(report, status_code=200 if is_ready else 503)
+
+    @app.get("/metrics")
+    async def prometheus_metrics() -> Response:
+        body, content_type = metrics.render()
+        return Response(body, media_type=content_type)
+
+    return gr.mount_gradio_app(app, blocks, path="/", root_path=root_path)
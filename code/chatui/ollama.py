@@ -15,16 +15,88 @@
 
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.load.dump import dumps
-from langchain_core.messages import ChatMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
+from langchain_core.messages import ChatMessage, ChatMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
 from pydantic import Field
-from typing import List, Mapping, Optional, Any
+from requests.adapters import HTTPAdapter
+from typing import AsyncIterator, Iterator, List, Mapping, Optional, Any
+import asyncio
+import httpx
 import requests
+import threading
+import weakref
 import json
 import logging
+import os
 
 _LOGGER = logging.getLogger(__name__)
 
+""" Connection pool settings shared by every OllamaChatModel instance. Override with environment variables. """
+
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "10"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "120"))
+OLLAMA_PULL_TIMEOUT = float(os.environ.get("OLLAMA_PULL_TIMEOUT", "3600"))
+OLLAMA_ASYNC_POOL_SIZE = int(os.environ.get("OLLAMA_ASYNC_POOL_SIZE", "200"))
+
+""" How long Ollama keeps a model loaded after the last request, so warmed models stay warm between questions. """
+
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+def normalize_server(server: str) -> str:
+    """ This is a helper function for ensuring the Ollama server URL carries a scheme. """
+    server = server.strip().rstrip("/")
+    if not (server.startswith("http://") or server.startswith("https://")):
+        server = f"http://{server}"
+    return server
+
+def _tracing():
+    """ This is a helper function for importing chatui.utils.tracing lazily; chatui.utils imports this module. """
+    from chatui.utils import tracing
+    return tracing
+
+def get_session(server: str, port: str) -> requests.Session:
+    """
+    Return the keep-alive session for an Ollama server, creating it on first use.
+
+    Sessions are shared per (server, port) so that the router, graders and generator
+    reuse pooled TCP connections instead of opening a new one on every call.
+    """
+    key = (normalize_server(server), str(port))
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.hooks["response"].append(_tracing().requests_response_hook)
+                _sessions[key] = session
+    return session
+
+def get_async_client(server: str, port: str) -> httpx.AsyncClient:
+    """
+    Return the pooled async HTTP client for an Ollama server on the running event loop.
+
+    httpx async clients are bound to the loop they were created on, so clients are
+    cached per loop and dropped together with it.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (normalize_server(server), str(port))
+    if key not in clients:
+        clients[key] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=OLLAMA_ASYNC_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE),
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            event_hooks=_tracing().httpx_event_hooks(asynchronous=True),
+        )
+    return clients[key]
+
 class OllamaChatModel(BaseChatModel):
     """A LangChain chat model for Ollama API."""
 
@@ -43,15 +115,78 @@ class OllamaChatModel(BaseChatModel):
     @property
     def _llm_type(self) -> str:
         return 'ollama'
+
+    @property
+    def _base_url(self) -> str:
+        return f"{normalize_server(self.ollama_server)}:{self.ollama_port}"
+
+    @property
+    def _session(self) -> requests.Session:
+        return get_session(self.ollama_server, self.ollama_port)
         
     def _generate(self, messages, stop=None, run_manager=None, **kwargs):
-        response = self._call_ollama_api(messages)
+        response = self._call_ollama_api(messages, stop=stop)
         return self._create_chat_result(response)
-    
-    def _call_ollama_api(self, messages, **kwargs):
-        """Call the Ollama API to generate text."""
-        base_url = f"{self.ollama_server}:{self.ollama_port}/api/chat"
-        
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        """Stream tokens from Ollama's NDJSON chat endpoint as they are generated."""
+        base_url = f"{self._base_url}/api/chat"
+        payload = self._build_payload(messages, stop=stop, stream=True)
+
+        try:
+            with self._session.post(base_url, json=payload, stream=True, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    part = json.loads(line)
+                    if "error" in part:
+                        raise ValueError(f"Ollama returned an error: {part['error']}")
+                    token = part.get("message", {}).get("content", "")
+                    if token:
+                        chunk = ChatGenerationChunk(message=ChatMessageChunk(content=token, role="assistant"))
+                        if run_manager:
+                            run_manager.on_llm_new_token(token, chunk=chunk)
+                        yield chunk
+                    if part.get("done"):
+                        break
+        except requests.exceptions.RequestException as e:
+            _LOGGER.error(f"Error streaming from Ollama API: {e}")
+            yield ChatGenerationChunk(message=ChatMessageChunk(content=f"Error: Could not connect to Ollama server at {self._base_url}", role="assistant"))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = await self._acall_ollama_api(messages, stop=stop)
+        return self._create_chat_result(response)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        """Asynchronously stream tokens from Ollama's NDJSON chat endpoint."""
+        base_url = f"{self._base_url}/api/chat"
+        payload = self._build_payload(messages, stop=stop, stream=True)
+        client = get_async_client(self.ollama_server, self.ollama_port)
+
+        try:
+            async with client.stream("POST", base_url, json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    part = json.loads(line)
+                    if "error" in part:
+                        raise ValueError(f"Ollama returned an error: {part['error']}")
+                    token = part.get("message", {}).get("content", "")
+                    if token:
+                        chunk = ChatGenerationChunk(message=ChatMessageChunk(content=token, role="assistant"))
+                        if run_manager:
+                            await run_manager.on_llm_new_token(token, chunk=chunk)
+                        yield chunk
+                    if part.get("done"):
+                        break
+        except httpx.HTTPError as e:
+            _LOGGER.error(f"Error streaming from Ollama API: {e}")
+            yield ChatGenerationChunk(message=ChatMessageChunk(content=f"Error: Could not connect to Ollama server at {self._base_url}", role="assistant"))
+
+    def _build_payload(self, messages, stop=None, stream=False):
+        """Build the Ollama chat API request body from LangChain messages."""
         # Convert LangChain messages to Ollama format
         obj = json.loads(dumps(messages))
         prompt_content = obj[0]["kwargs"]["content"]
@@ -60,19 +195,43 @@ class OllamaChatModel(BaseChatModel):
         payload = {
             "model": self.model_name,
             "messages": [{"role": "user", "content": prompt_content}],
+            "stream": stream,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
             "options": {
                 "temperature": self.temperature
             }
         }
+        if stop:
+            payload["options"]["stop"] = stop
+        return payload
+    
+    def _call_ollama_api(self, messages, stop=None, **kwargs):
+        """Call the Ollama API to generate text."""
+        base_url = f"{self._base_url}/api/chat"
+        payload = self._build_payload(messages, stop=stop, stream=False)
         
         try:
-            response = requests.post(base_url, json=payload)
+            response = self._session.post(base_url, json=payload, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT))
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             _LOGGER.error(f"Error calling Ollama API: {e}")
-            return {"message": {"content": f"Error: Could not connect to Ollama server at {self.ollama_server}:{self.ollama_port}"}}
+            return {"message": {"content": f"Error: Could not connect to Ollama server at {self._base_url}"}}
     
+    async def _acall_ollama_api(self, messages, stop=None, **kwargs):
+        """Call the Ollama API to generate text without blocking the event loop."""
+        base_url = f"{self._base_url}/api/chat"
+        payload = self._build_payload(messages, stop=stop, stream=False)
+        client = get_async_client(self.ollama_server, self.ollama_port)
+
+        try:
+            response = await client.post(base_url, json=payload)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            _LOGGER.error(f"Error calling Ollama API: {e}")
+            return {"message": {"content": f"Error: Could not connect to Ollama server at {self._base_url}"}}
+
     def _create_chat_result(self, response):
         """Create a ChatResult from the Ollama response."""
         try:
@@ -88,25 +247,42 @@ class OllamaChatModel(BaseChatModel):
 
     def list_models(self):
         """List all available models in the Ollama server."""
-        url = f"{self.ollama_server}:{self.ollama_port}/api/tags"
+        url = f"{self._base_url}/api/tags"
         try:
-            response = requests.get(url)
+            response = self._session.get(url, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT))
             response.raise_for_status()
             return response.json().get("models", [])
         except requests.exceptions.RequestException as e:
             _LOGGER.error(f"Error listing Ollama models: {e}")
             return []
             
+    def preload(self):
+        """Load the model into memory without generating, keeping it loaded for OLLAMA_KEEP_ALIVE. Raises on failure."""
+        url = f"{self._base_url}/api/generate"
+        payload = {
+            "model": self.model_name,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }
+        response = self._session.post(url, json=payload, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT))
+        response.raise_for_status()
+        return response.json()
+
     def pull_model(self, model_name):
         """Pull a model from the Ollama library if not already installed."""
-        url = f"{self.ollama_server}:{self.ollama_port}/api/pull"
+        url = f"{self._base_url}/api/pull"
         payload = {
             "name": model_name
         }
         try:
-            response = requests.post(url, json=payload, stream=True)
-            response.raise_for_status()
+            # Drain the progress stream so the pooled connection is released once the pull completes
+            with self._session.post(url, json=payload, stream=True, timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_PULL_TIMEOUT)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    status = json.loads(line) if line else {}
+                    if "error" in status:
+                        _LOGGER.error(f"Error pulling Ollama model {model_name}: {status['error']}")
+                        return False
             return True
         except requests.exceptions.RequestException as e:
             _LOGGER.error(f"Error pulling Ollama model {model_name}: {e}")
-            return False
\ No newline at end of file
+            return False
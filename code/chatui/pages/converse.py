@@ -25,9 +25,9 @@ import subprocess
 import time
 import sys
 
-from chatui import assets, chat_client
+from chatui import assets, chat_client, ollama
 from chatui.prompts import prompts_llama3, prompts_mistral, defaults
-from chatui.utils import compile, database, logger, nim
+from chatui.utils import cache, compile, database, graph, logger, nim, streaming, tracing, warmup
 
 from langgraph.graph import END, StateGraph
 
@@ -94,136 +94,6 @@ _LOCAL_CSS = """
 
 sys.stdout = logger.Logger("/project/code/output.log")
 
-# Helper class for Ollama integration
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.load.dump import dumps
-from langchain_core.messages import ChatMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
-from pydantic import Field
-import requests
-import json
-import logging
-
-class OllamaChatModel(BaseChatModel):
-    """A LangChain chat model for Ollama API."""
-
-    ollama_server: str = Field("http://localhost", description='URL of the Ollama server')
-    ollama_port: str = Field("11434", description='Port of the Ollama server')
-    model_name: str = Field("llama3", description='Name of the Ollama model to use')
-    temperature: float = Field(0.7, description='Temperature for text generation')
-    
-    def __init__(self, ollama_server="http://localhost", ollama_port="11434", model_name="llama3", temperature=0.7, **kwargs):
-        super().__init__(**kwargs)
-        self.ollama_server = ollama_server
-        self.ollama_port = ollama_port
-        self.model_name = model_name
-        self.temperature = temperature
-        print(f"Initialized OllamaChatModel with server: {ollama_server}, port: {ollama_port}, model: {model_name}")
-
-    @property
-    def _llm_type(self) -> str:
-        return 'ollama'
-        
-    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
-        print(f"_generate called with messages: {messages[:100]}...")
-        response = self._call_ollama_api(messages)
-        return self._create_chat_result(response)
-    
-    def _call_ollama_api(self, messages, **kwargs):
-        """Call the Ollama API to generate text."""
-        # Ensure ollama_server starts with http:// or https://
-        server = self.ollama_server
-        if not (server.startswith('http://') or server.startswith('https://')):
-            server = f"http://{server}"
-            
-        base_url = f"{server}:{self.ollama_port}/api/chat"
-        print(f"Calling Ollama API at: {base_url}")
-        
-        # Convert LangChain messages to Ollama format
-        obj = json.loads(dumps(messages))
-        prompt_content = obj[0]["kwargs"]["content"]
-        
-        # Format for Ollama chat API
-        payload = {
-            "model": self.model_name,
-            "messages": [{"role": "user", "content": prompt_content}],
-            "options": {
-                "temperature": self.temperature
-            }
-        }
-        print(f"Payload: {json.dumps(payload)[:100]}...")
-        
-        try:
-            print(f"Sending POST request to {base_url}")
-            response = requests.post(base_url, json=payload)
-            print(f"Response status code: {response.status_code}")
-            response.raise_for_status()
-            resp_json = response.json()
-            print(f"Response JSON: {str(resp_json)[:100]}...")
-            return resp_json
-        except Exception as e:
-            print(f"Error in _call_ollama_api: {str(e)}")
-            return {"message": {"content": f"Error: Could not connect to Ollama server at {server}:{self.ollama_port}. Error: {str(e)}"}}
-    
-    def _create_chat_result(self, response):
-        """Create a ChatResult from the Ollama response."""
-        try:
-            content = response.get("message", {}).get("content", "No response from model")
-            print(f"Creating chat result with content: {content[:100]}...")
-            message = ChatMessage(content=content, role="assistant")
-            generation = ChatGeneration(message=message)
-            return ChatResult(generations=[generation])
-        except Exception as e:
-            print(f"Error in _create_chat_result: {str(e)}")
-            message = ChatMessage(content=f"Error processing model response: {str(e)}", role="assistant")
-            generation = ChatGeneration(message=message)
-            return ChatResult(generations=[generation])
-
-    def list_models(self):
-        """List all available models in the Ollama server."""
-        # Ensure ollama_server starts with http:// or https://
-        server = self.ollama_server
-        if not (server.startswith('http://') or server.startswith('https://')):
-            server = f"http://{server}"
-            
-        url = f"{server}:{self.ollama_port}/api/tags"
-        print(f"Listing models from: {url}")
-        try:
-            print(f"Sending GET request to {url}")
-            response = requests.get(url)
-            print(f"Response status code: {response.status_code}")
-            response.raise_for_status()
-            resp_json = response.json()
-            print(f"Models response: {str(resp_json)[:100]}...")
-            return resp_json.get("models", [])
-        except Exception as e:
-            print(f"Error in list_models: {str(e)}")
-            return []
-            
-    def pull_model(self, model_name):
-        """Pull a model from the Ollama library if not already installed."""
-        # Ensure ollama_server starts with http:// or https://
-        server = self.ollama_server
-        if not (server.startswith('http://') or server.startswith('https://')):
-            server = f"http://{server}"
-            
-        url = f"{server}:{self.ollama_port}/api/pull"
-        print(f"Pulling model from: {url}")
-        payload = {
-            "name": model_name
-        }
-        print(f"Pull payload: {json.dumps(payload)}")
-        try:
-            print(f"Sending POST request to {url}")
-            response = requests.post(url, json=payload, stream=True)
-            print(f"Response status code: {response.status_code}")
-            response.raise_for_status()
-            print("Model pulled successfully")
-            return True
-        except Exception as e:
-            print(f"Error in pull_model: {str(e)}")
-            return False
-
 def build_page(client: chat_client.ChatClient) -> gr.Blocks:
     """
     Build the gradio page to be mounted in the frame.
@@ -354,6 +224,18 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                                 with gr.TabItem("Hide", id=2) as router_hide:
                                     gr.Markdown("")
 
+                            fast_router = gr.Checkbox(label="Fast Router",
+                                                      value=True,
+                                                      info="Route confidently classified questions by embedding similarity and only call the router model for ambiguous ones. Skipped while the router prompt is edited.",
+                                                      elem_id="rag-inputs",
+                                                      interactive=True)
+
+                            speculative_retrieval = gr.Checkbox(label="Speculative Retrieval",
+                                                                value=False,
+                                                                info="Search the vector database while the router runs. Hides retrieval latency behind routing at the cost of a wasted search when the question is routed to the web.",
+                                                                elem_id="rag-inputs",
+                                                                interactive=True)
+
                             with gr.Accordion("Configure the Router Prompt", 
                                               elem_id="rag-inputs", open=False) as accordion_router:
                                 prompt_router = gr.Textbox(value=prompts_llama3.router_prompt,
@@ -391,6 +273,13 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
 
                                 with gr.TabItem("Hide", id=2) as retrieval_hide:
                                     gr.Markdown("")
+
+                            retrieval_grading_mode = gr.Radio([("Per Document", "per_document"), ("Single Call", "single_call")],
+                                                              value="per_document",
+                                                              label="Grading Mode",
+                                                              info="Single Call grades all documents in one request; best when request overhead dominates, eg. remote API endpoints. It uses a built-in batch prompt, so with an edited grader prompt documents are graded per document instead.",
+                                                              elem_id="rag-inputs",
+                                                              interactive=True)
                             
                             with gr.Accordion("Configure the Retrieval Grader Prompt", 
                                               elem_id="rag-inputs", open=False) as accordion_retrieval:
@@ -512,6 +401,12 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                                                                   lines=17,
                                                                   show_label=False,
                                                                   interactive=True)
+
+                        speculative_grading = gr.Checkbox(label="Speculative Grading",
+                                                          value=False,
+                                                          info="Run the hallucination and answer graders concurrently. Saves a round trip on every useful answer at the cost of an extra answer grader call when the hallucination check fails.",
+                                                          elem_id="rag-inputs",
+                                                          interactive=True)
                         
                     # Ollama Configuration Tab
                     with gr.TabItem("Ollama", id=3, interactive=False, visible=False) as ollama_settings:
@@ -633,12 +528,18 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                                     visible=True,
                                     elem_id="contextbox",
                                 )
+                            with gr.TabItem("Cache Stats", id=2) as cache_tab:
+                                cache_stats = gr.JSON(show_label=False, visible=True)
+                            with gr.TabItem("Trace Waterfall", id=3) as waterfall_tab:
+                                waterfall = gr.Textbox(show_label=False, lines=15, max_lines=30, interactive=False)
                     
                     # Fourth tab item is for collapsing the entire settings pane for readability. 
                     with gr.TabItem("Hide All Settings", id=5, interactive=True, visible=True) as hide_all_settings:
                         gr.Markdown("")
 
         page.load(logger.read_logs, None, logs, every=1)
+        page.load(cache.stats, None, cache_stats, every=5)
+        page.load(tracing.last_waterfall, None, waterfall, every=2)
 
         """ This helper function runs the initialization tasks of the chat application, if needed. """
 
@@ -651,6 +552,9 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
             database.initialize_pdf_retriever()
             progress(0.67, desc="Initializing Image Retriever")
             database.initialize_img_retriever()
+            progress(0.75, desc="Warming Up Models")
+            # A no-op when the app was started through __main__, which already began warming in the background
+            warmup.start_background_warmup()
             progress(0.83, desc="Cleaning up")
             time.sleep(0.75)
             return {
@@ -793,6 +697,39 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
         hallucination_nim.select(_toggle_hallucination_endpoints, [model_hallucination, nim_hallucination_id], [hallucination_use_nim, prompt_hallucination])
         answer_api.select(_toggle_answer_endpoints, [model_answer, nim_answer_id], [answer_use_nim, prompt_answer])
         answer_nim.select(_toggle_answer_endpoints, [model_answer, nim_answer_id], [answer_use_nim, prompt_answer])
+
+        def _warm_role(role, use_nim_val, use_ollama_val, nim_ip, nim_port, nim_id, model_id):
+            """ Warms the API or NIM model now serving a role, so its first question does not pay the load time. """
+            # With Ollama on, it serves every role and its model is warmed by _warm_ollama_model
+            if use_ollama_val:
+                return
+            keys = graph.ROLES[role]
+            settings = {keys["prompt_key"]: "",
+                        keys["use_nim_key"]: use_nim_val,
+                        keys["nim_ip_key"]: nim_ip,
+                        keys["nim_port_key"]: nim_port,
+                        keys["nim_id_key"]: nim_id,
+                        keys["model_key"]: model_id}
+            target = graph.resolve_role(settings, role).target
+            if target[0] == "nim" and not target[1]:
+                return
+            warmup.start_background_warmup([target], embedders=False, gating=False)
+
+        for role, api_tab, nim_tab, use_nim, model, nim_ip, nim_port, nim_id in (
+            ("router", router_api, router_nim, router_use_nim, model_router, nim_router_ip, nim_router_port, nim_router_id),
+            ("retrieval", retrieval_api, retrieval_nim, retrieval_use_nim, model_retrieval, nim_retrieval_ip, nim_retrieval_port, nim_retrieval_id),
+            ("generator", generator_api, generator_nim, generator_use_nim, model_generator, nim_generator_ip, nim_generator_port, nim_generator_id),
+            ("hallucination", hallucination_api, hallucination_nim, hallucination_use_nim, model_hallucination, nim_hallucination_ip, nim_hallucination_port, nim_hallucination_id),
+            ("answer", answer_api, answer_nim, answer_use_nim, model_answer, nim_answer_ip, nim_answer_port, nim_answer_id),
+        ):
+            endpoint_inputs = [use_ollama_state, nim_ip, nim_port, nim_id, model]
+            # The tab being selected decides the backend; the use_nim state may not be updated yet
+            api_tab.select(functools.partial(_warm_role, role, False), endpoint_inputs, None)
+            nim_tab.select(functools.partial(_warm_role, role, True), endpoint_inputs, None)
+            model.change(functools.partial(_warm_role, role), [use_nim] + endpoint_inputs, None)
+            # Textboxes warm once edited rather than on every keystroke
+            for textbox in (nim_ip, nim_port, nim_id):
+                textbox.blur(functools.partial(_warm_role, role), [use_nim] + endpoint_inputs, None)
         
         """ These helper functions hide and show the right-hand settings panel when toggled. """
         
@@ -1053,6 +990,12 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
         model_generator.change(_toggle_model_generator, [model_generator], [prompt_generator])
         model_hallucination.change(_toggle_model_hallucination, [model_hallucination], [prompt_hallucination])
         model_answer.change(_toggle_model_answer, [model_answer], [prompt_answer])
+
+        """ This helper function drops cached routing decisions, which were made under the previous router prompt. """
+        def _flush_route_cache():
+            cache.route_cache.clear()
+
+        prompt_router.change(_flush_route_cache, None, None)
         
         """ These helper functions upload and clear the documents to/from the LanceDB. """
 
@@ -1243,7 +1186,7 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
         # Ollama related functions
         def _refresh_ollama_models(server, port):
             try:
-                ollama_client = OllamaChatModel(ollama_server=server, ollama_port=port)
+                ollama_client = ollama.OllamaChatModel(ollama_server=server, ollama_port=port)
                 models = ollama_client.list_models()
                 
                 model_names = []
@@ -1258,7 +1201,7 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
 
         def _pull_ollama_model(server, port, model_name):
             try:
-                ollama_client = OllamaChatModel(ollama_server=server, ollama_port=port)
+                ollama_client = ollama.OllamaChatModel(ollama_server=server, ollama_port=port)
                 success = ollama_client.pull_model(model_name)
                 
                 if success:
@@ -1276,6 +1219,11 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
             
         def _update_ollama_state(use_ollama_val, server, port, model):
             return use_ollama_val, server, port, model
+
+        """ This helper function loads the selected Ollama model in the background so the next question does not wait on it. """
+        def _warm_ollama_model(use_ollama_val, server, port, model):
+            if use_ollama_val and model:
+                warmup.start_background_warmup([("ollama", server, port, model)], embedders=False, gating=False)
         
         # Connect Ollama UI components to functions
         use_ollama.change(_update_ollama_state, [use_ollama, ollama_server, ollama_port, ollama_model], 
@@ -1287,6 +1235,9 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
         ollama_model.change(_update_ollama_state, [use_ollama, ollama_server, ollama_port, ollama_model], 
                            [use_ollama_state, ollama_server_state, ollama_port_state, ollama_model_state])
 
+        use_ollama.change(_warm_ollama_model, [use_ollama, ollama_server, ollama_port, ollama_model], None)
+        ollama_model.change(_warm_ollama_model, [use_ollama, ollama_server, ollama_port, ollama_model], None)
+
         refresh_ollama_models.click(_refresh_ollama_models, [ollama_server, ollama_port], [available_models])
         available_models.change(lambda x: x, [available_models], [ollama_model])
         pull_model.click(_handle_pull_model, [ollama_server, ollama_port, ollama_model], [pull_status, available_models])
@@ -1332,6 +1283,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
             nim_retrieval_id: str,
             nim_hallucination_id: str,
             nim_answer_id: str,
+            retrieval_grading_mode: str,
+            speculative_grading: bool,
+            fast_router: bool,
+            speculative_retrieval: bool,
             use_ollama: bool,
             ollama_server: str,
             ollama_port: str,
@@ -1339,54 +1294,101 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
             chat_history: List[Tuple[str, str]],
         ) -> Any:
 
-            inputs = {"question": question, 
-                      "generator_model_id": model_generator, 
-                      "router_model_id": model_router, 
-                      "retrieval_model_id": model_retrieval, 
-                      "hallucination_model_id": model_hallucination, 
-                      "answer_model_id": model_answer, 
-                      "prompt_generator": prompt_generator, 
-                      "prompt_router": prompt_router, 
-                      "prompt_retrieval": prompt_retrieval, 
-                      "prompt_hallucination": prompt_hallucination, 
-                      "prompt_answer": prompt_answer, 
-                      "router_use_nim": router_use_nim, 
-                      "retrieval_use_nim": retrieval_use_nim, 
-                      "generator_use_nim": generator_use_nim, 
-                      "hallucination_use_nim": hallucination_use_nim, 
-                      "nim_generator_ip": nim_generator_ip,
-                      "nim_router_ip": nim_router_ip,
-                      "nim_retrieval_ip": nim_retrieval_ip,
-                      "nim_hallucination_ip": nim_hallucination_ip,
-                      "nim_answer_ip": nim_answer_ip,
-                      "nim_generator_port": nim_generator_port,
-                      "nim_router_port": nim_router_port,
-                      "nim_retrieval_port": nim_retrieval_port,
-                      "nim_hallucination_port": nim_hallucination_port,
-                      "nim_answer_port": nim_answer_port,
-                      "nim_generator_id": nim_generator_id,
-                      "nim_router_id": nim_router_id,
-                      "nim_retrieval_id": nim_retrieval_id,
-                      "nim_hallucination_id": nim_hallucination_id,
-                      "nim_answer_id": nim_answer_id,
-                      "use_ollama": use_ollama,
-                      "ollama_server": ollama_server,
-                      "ollama_port": ollama_port,
-                      "ollama_model": ollama_model,
-                      "answer_use_nim": answer_use_nim}
+            settings = {"generator_model_id": model_generator, 
+                        "router_model_id": model_router, 
+                        "retrieval_model_id": model_retrieval, 
+                        "hallucination_model_id": model_hallucination, 
+                        "answer_model_id": model_answer, 
+                        "prompt_generator": prompt_generator, 
+                        "prompt_router": prompt_router, 
+                        "prompt_retrieval": prompt_retrieval, 
+                        "prompt_hallucination": prompt_hallucination, 
+                        "prompt_answer": prompt_answer, 
+                        "router_use_nim": router_use_nim, 
+                        "retrieval_use_nim": retrieval_use_nim, 
+                        "generator_use_nim": generator_use_nim, 
+                        "hallucination_use_nim": hallucination_use_nim, 
+                        "nim_generator_ip": nim_generator_ip,
+                        "nim_router_ip": nim_router_ip,
+                        "nim_retrieval_ip": nim_retrieval_ip,
+                        "nim_hallucination_ip": nim_hallucination_ip,
+                        "nim_answer_ip": nim_answer_ip,
+                        "nim_generator_port": nim_generator_port,
+                        "nim_router_port": nim_router_port,
+                        "nim_retrieval_port": nim_retrieval_port,
+                        "nim_hallucination_port": nim_hallucination_port,
+                        "nim_answer_port": nim_answer_port,
+                        "nim_generator_id": nim_generator_id,
+                        "nim_router_id": nim_router_id,
+                        "nim_retrieval_id": nim_retrieval_id,
+                        "nim_hallucination_id": nim_hallucination_id,
+                        "nim_answer_id": nim_answer_id,
+                        "retrieval_grading_mode": retrieval_grading_mode,
+                        "speculative_grading": speculative_grading,
+                        "fast_router": fast_router,
+                        "speculative_retrieval": speculative_retrieval,
+                        "use_ollama": use_ollama,
+                        "ollama_server": ollama_server,
+                        "ollama_port": ollama_port,
+                        "ollama_model": ollama_model,
+                        "answer_use_nim": answer_use_nim}
+            # Resolve the settings once into an immutable run configuration, referenced (not copied) by the graph state
+            run_config = graph.RunConfig.from_settings(settings)
+            inputs = {"question": question, "config": run_config}
             
             if not valid_input(question):
                 yield "", chat_history + [[str(question), "*** ERR: Unable to process query. Query cannot be empty. ***"]], gr.update(show_label=False)
             else: 
+                # Gradio may resume this generator on different threads, so the request span is passed along explicitly
+                request_span = tracing.Span("chat_request", **{"question.chars": len(question)})
                 try:
+                    cached_answer = None
+                    kb_version = database.get_kb_version()
+                    if cache.ANSWER_CACHE_ENABLED:
+                        try:
+                            with tracing.use_span(request_span), tracing.span("answer_cache.lookup"):
+                                cached_answer = cache.answer_cache.lookup(question, run_config)
+                        except Exception as e:
+                            print(f"---ANSWER CACHE LOOKUP FAILED ({e}), RUNNING GRAPH---")
+                    request_span.set_attribute("answer_cache.hit", cached_answer is not None)
+                    if cached_answer is not None:
+                        print("---ANSWER CACHE HIT---")
+                        request_span.end()
+                        yield "", chat_history + [[question, cached_answer]], gr.update(value={"answer_cache": cache.answer_cache.stats()})
+                        return
                     actions = {}
-                    for output in app.stream(inputs):
-                        actions.update(output)
-                        yield "", chat_history + [[question, "Working on getting you the best answer..."]], gr.update(value=actions)
-                        for key, value in output.items():
+                    draft = ""
+                    status = "Working on getting you the best answer..."
+                    for kind, event in streaming.stream_graph(app, inputs, span=request_span):
+                        if kind == streaming.ERROR:
+                            raise event
+                        if kind == streaming.TOKEN:
+                            # A retry starts a fresh draft, replacing the one that failed grading
+                            if status is not None:
+                                draft, status = "", None
+                            draft += event
+                            yield "", chat_history + [[question, draft]], gr.update()
+                            continue
+                        actions.update(event)
+                        for key, value in event.items():
                             final_value = value
+                            if key == "generate":
+                                status = "*Checking the answer...*"
+                            elif key == "grade_generation" and value["generation_grade"] != "useful":
+                                status = "*This draft did not pass grading and is being revised...*"
+                        shown = f"{draft}\n\n{status}" if draft and status else (draft or status)
+                        yield "", chat_history + [[question, shown]], gr.update(value=actions)
+                    # Unverified answers ran out of budget before passing grading; do not serve them again
+                    if cache.ANSWER_CACHE_ENABLED and final_value.get("verified", True):
+                        try:
+                            cache.answer_cache.store(question, run_config, final_value["generation"], kb_version)
+                        except Exception as e:
+                            print(f"---ANSWER CACHE STORE FAILED ({e})---")
+                    request_span.set_attribute("verified", final_value.get("verified", True))
+                    request_span.end()
                     yield "", chat_history + [[question, final_value["generation"]]], gr.update(show_label=False)
                 except Exception as e: 
+                    request_span.end(error=e)
                     yield "", chat_history + [[question, "*** ERR: Unable to process query. See Monitor tab for details. ***\n\nException: " + str(e)]], gr.update(show_label=False)
 
         # Submit a sample query
@@ -1424,6 +1426,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                             nim_retrieval_id,
                             nim_hallucination_id,
                             nim_answer_id,
+                            retrieval_grading_mode,
+                            speculative_grading,
+                            fast_router,
+                            speculative_retrieval,
                             use_ollama_state,
                             ollama_server_state,
                             ollama_port_state,
@@ -1463,6 +1469,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                             nim_retrieval_id,
                             nim_hallucination_id,
                             nim_answer_id,
+                            retrieval_grading_mode,
+                            speculative_grading,
+                            fast_router,
+                            speculative_retrieval,
                             use_ollama_state,
                             ollama_server_state,
                             ollama_port_state,
@@ -1502,6 +1512,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                             nim_retrieval_id,
                             nim_hallucination_id,
                             nim_answer_id,
+                            retrieval_grading_mode,
+                            speculative_grading,
+                            fast_router,
+                            speculative_retrieval,
                             use_ollama_state,
                             ollama_server_state,
                             ollama_port_state,
@@ -1541,6 +1555,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                             nim_retrieval_id,
                             nim_hallucination_id,
                             nim_answer_id,
+                            retrieval_grading_mode,
+                            speculative_grading,
+                            fast_router,
+                            speculative_retrieval,
                             use_ollama_state,
                             ollama_server_state,
                             ollama_port_state,
@@ -1580,6 +1598,10 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
                             nim_retrieval_id,
                             nim_hallucination_id,
                             nim_answer_id,
+                            retrieval_grading_mode,
+                            speculative_grading,
+                            fast_router,
+                            speculative_retrieval,
                             use_ollama_state,
                             ollama_server_state,
                             ollama_port_state,
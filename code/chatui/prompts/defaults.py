@@ -27,4 +27,37 @@ vllm_prompt = """
 You are an expert data analyst and visualization specialist. You are about to see an image that may be, but not necessarily, related to a developer tool for container management and Git-based projects called NVIDIA AI Workbench. Your task is to carefully examine the provided image, which may be of a chart, table, or diagram, and create an highly extensive and comprehensive description that captures all the key information in the image. 
 
 For charts, graphs, tables, and diagrams, transcribe the data being displayed into a table. Make sure you include every single data entry and their corresponding value(s). Then, describe any trends, patterns, outliers, or key insights visible in the data. Finally, summarize the main message or conclusion that can be drawn from the visualization and infer how it may relate to NVIDIA AI Workbench.
-"""
\ No newline at end of file
+"""
+""" These are the labeled exemplar queries the local fast router compares questions against. Adjust as needed! """
+
+router_exemplars = {
+    "vectorstore": [
+        "What OS versions are supported by AI Workbench?",
+        "How do I get started with AI Workbench?",
+        "How do I fix an inaccessible remote Location?",
+        "How do I create a support bundle in AI Workbench CLI?",
+        "How do I install NVIDIA AI Workbench on Windows?",
+        "How do I install AI Workbench on a remote Ubuntu machine?",
+        "How do I clone a project in AI Workbench?",
+        "How do I add a custom app to my Workbench project?",
+        "Where can I find the AI Workbench logs?",
+        "How do I configure a GPU for my project container?",
+        "Can AI Workbench use Podman instead of Docker?",
+        "How do I use the nvwb CLI to start an environment?",
+        "How do I run a NIM locally with AI Workbench?",
+        "How do I set up the hybrid RAG example project?",
+        "Why won't my JupyterLab app start in Workbench?",
+    ],
+    "web_search": [
+        "What is the weather in Santa Clara today?",
+        "Who won the last World Cup?",
+        "What is the latest stock price of NVIDIA?",
+        "What's a good recipe for banana bread?",
+        "Who is the current president of France?",
+        "What time is it in Tokyo?",
+        "What are the latest news headlines?",
+        "How tall is Mount Everest?",
+        "Recommend a good science fiction novel.",
+        "What is the capital of Australia?",
+    ],
+}
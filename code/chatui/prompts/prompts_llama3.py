@@ -37,6 +37,19 @@ Here is the user question: {question}
 <|eot_id|><|start_header_id|>assistant<|end_header_id|>
 """
 
+retrieval_batch_prompt = """
+<|begin_of_text|><|start_header_id|>system<|end_header_id|> 
+You are a grader assessing relevance of {count} numbered retrieved documents to a user question. If a document contains keywords related to the user question, grade it as relevant. It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
+Give a binary score 'yes' or 'no' for every document, in the same order as the documents are numbered. \n
+Your response format is non-negotiable: you must provide the scores as a JSON with a single key 'scores' holding a list of exactly {count} 'yes' or 'no' strings and no preamble or explanation.
+
+<|eot_id|><|start_header_id|>user<|end_header_id|>
+Here are the retrieved documents: \n {documents} \n
+Here is the user question: {question} 
+
+<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+"""
+
 generator_prompt = """
 <|begin_of_text|><|start_header_id|>system<|end_header_id|> 
 You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use six sentences maximum and keep the answer concise but helpful. 
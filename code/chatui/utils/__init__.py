@@ -15,10 +15,20 @@
 
 # Import and re-export individual modules
 from . import database
+from . import dedup
+from . import cache
 from . import compile
+from . import embeddings
+from . import indexing
 from . import logger
+from . import metrics
 from . import nim
+from . import reranker
+from . import router
+from . import streaming
+from . import tracing
+from . import warmup
 from .. import ollama
 
 # Define what's available when doing 'from chatui.utils import *'
-__all__ = ['database', 'compile', 'logger', 'nim', 'ollama']
\ No newline at end of file
+__all__ = ['database', 'dedup', 'cache', 'compile', 'embeddings', 'indexing', 'logger', 'metrics', 'nim', 'reranker', 'router', 'streaming', 'tracing', 'warmup', 'ollama']
\ No newline at end of file
@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from chatui.utils import database, embeddings
+
+""" Caches that let repeated questions skip some or all of the agentic graph. """
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+ROUTE_CACHE_TTL = float(os.environ.get("ROUTE_CACHE_TTL", "86400"))
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", "1024"))
+
+def normalize_question(question: str) -> str:
+    """ This is a helper function for collapsing case, punctuation and whitespace differences between questions. """
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+
+class TTLCache:
+    """ A thread-safe LRU cache whose entries also expire after a fixed time-to-live. """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def items(self):
+        """ Returns the live (key, value) pairs, dropping expired entries, without touching recency. """
+        with self._lock:
+            now = time.monotonic()
+            for key in [key for key, entry in self._entries.items() if now - entry[0] > self.ttl]:
+                del self._entries[key]
+            return [(key, entry[1]) for key, entry in self._entries.items()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class SemanticCache:
+    """
+    Caches final answers keyed by question embedding and run configuration (a hashable graph.RunConfig).
+
+    A lookup hits when a stored question under the same configuration is within the cosine
+    similarity threshold. Entries expire after a TTL, the least recently used are evicted
+    first, and the whole cache is flushed whenever the knowledge base version changes.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, ttl: float):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = TTLCache(max_entries, ttl)
+        self._kb_version = database.get_kb_version()
+        self._lock = threading.Lock()
+
+    def _check_kb_version(self):
+        with self._lock:
+            if self._kb_version != database.get_kb_version():
+                self._kb_version = database.get_kb_version()
+                self._entries.clear()
+
+    def _embed(self, question: str):
+        vector = np.asarray(embeddings.text_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, question: str, config):
+        """ Returns the cached answer for a semantically similar question under the same configuration, or None. """
+        self._check_kb_version()
+        vector = self._embed(question)
+        best, best_score = None, self.threshold
+        for key, (entry_config, entry_vector, _answer) in self._entries.items():
+            if entry_config != config:
+                continue
+            score = float(np.dot(vector, entry_vector))
+            if score >= best_score:
+                best, best_score = key, score
+        entry = self._entries.get(best) if best is not None else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[2]
+
+    def store(self, question: str, config, answer: str, kb_version: int):
+        """
+        Caches the final answer to a question under the given configuration.
+
+        kb_version is the knowledge base version the answer was produced against; the answer
+        is dropped if the knowledge base changed while the graph was running.
+        """
+        self._check_kb_version()
+        if kb_version != database.get_kb_version():
+            return
+        self._entries.put((config, question.strip().lower()), (config, self._embed(question), answer))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._entries.stats()["size"]}
+
+
+answer_cache = SemanticCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+""" Routing decisions keyed by (normalized question, router RoleConfig). """
+
+route_cache = TTLCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL)
+
+def stats():
+    """ Returns hit/miss counts and sizes of every cache, for sizing them. """
+    return {"answer_cache": answer_cache.stats(), "route_cache": route_cache.stats(), "query_embeddings": embeddings.stats()}
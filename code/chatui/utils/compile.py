@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from langgraph.graph import END, StateGraph
-from chatui.utils import graph
+from chatui.utils import graph, reranker
 
 """ This function compiles the graph components and actions defined in graph.py """
 
@@ -24,21 +24,34 @@ def compile_graph():
     workflow = StateGraph(graph.GraphState)
     
     # Define the nodes
+    workflow.add_node("route", graph.route)  # route, with optional speculative retrieval
     workflow.add_node("websearch", graph.web_search)  # web search
     workflow.add_node("retrieve", graph.retrieve)  # retrieve
     workflow.add_node("grade_documents", graph.grade_documents)  # grade documents
+    rerank = reranker.enabled()
+    if rerank:
+        workflow.add_node("rerank", graph.rerank)  # prune retrieved documents with a local cross-encoder
     workflow.add_node("generate", graph.generate)  # generate
+    workflow.add_node("grade_generation", graph.grade_generation)  # grade generation
+    workflow.add_node("finalize", graph.finalize)  # return the best generation unverified
 
     # Build graph
-    workflow.set_conditional_entry_point(
-        graph.route_question,
+    workflow.set_entry_point("route")
+    workflow.add_conditional_edges(
+        "route",
+        graph.decide_to_retrieve,
         {
             "websearch": "websearch",
-            "vectorstore": "retrieve",
+            "retrieve": "retrieve",
+            "grade_documents": "rerank" if rerank else "grade_documents",
         },
     )
     
-    workflow.add_edge("retrieve", "grade_documents")
+    if rerank:
+        workflow.add_edge("retrieve", "rerank")
+        workflow.add_edge("rerank", "grade_documents")
+    else:
+        workflow.add_edge("retrieve", "grade_documents")
     workflow.add_conditional_edges(
         "grade_documents",
         graph.decide_to_generate,
@@ -48,15 +61,18 @@ def compile_graph():
         },
     )
     workflow.add_edge("websearch", "generate")
+    workflow.add_edge("generate", "grade_generation")
     workflow.add_conditional_edges(
-        "generate",
-        graph.grade_generation_v_documents_and_question,
+        "grade_generation",
+        graph.decide_after_grading,
         {
             "not supported": "generate",
             "useful": END,
             "not useful": "websearch",
+            "exhausted": "finalize",
         },
     )
+    workflow.add_edge("finalize", END)
 
     return workflow
 
@@ -26,8 +26,13 @@ import speech_recognition as sr
 from pytubefix import YouTube
 from pprint import pprint
 
+import datetime
+import functools
+import json
 import os 
+import re
 import shutil
+import lancedb
 import nltk
 import requests, base64
 
@@ -35,8 +40,12 @@ from llama_index.core.indices import MultiModalVectorStoreIndex
 from llama_index.core import SimpleDirectoryReader, StorageContext, load_index_from_storage
 from llama_index.vector_stores.lancedb import LanceDBVectorStore
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores import VectorStoreQuery
+from langchain.schema import Document
 
 from chatui.prompts import defaults
+from chatui.utils import dedup, indexing, metrics, nim
 
 """ Global variables. Cuts down on retrieval time for now, can refactor. """
 
@@ -47,6 +56,209 @@ documents = None
 img_vectorstore = None
 web_vectorstore = None
 pdf_vectorstore = None
+text_embedder = None
+image_embedder = None
+
+""" Timeouts (connect, read) in seconds for HTTP calls made while ingesting into the knowledge base. """
+
+INGEST_CONNECT_TIMEOUT = float(os.environ.get("INGEST_CONNECT_TIMEOUT", "10"))
+INGEST_READ_TIMEOUT = float(os.environ.get("INGEST_READ_TIMEOUT", "120"))
+
+""" Incremented whenever the knowledge base changes, so caches built on top of it know to invalidate. """
+
+kb_version = 0
+
+def bump_kb_version():
+    """ This is a helper function for signalling that the contents of the knowledge base have changed. """
+    global kb_version
+    kb_version += 1
+
+def get_kb_version():
+    """ This is a helper function for returning the current version of the knowledge base. """
+    return kb_version
+
+def invalidates_kb(fn):
+    """ Decorator for functions that modify the knowledge base; bumps the version and schedules index maintenance even if they fail part way. """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            bump_kb_version()
+            indexing.schedule_maintenance()
+    return wrapper
+
+def nvidia_embeddings(model: str):
+    """ This is a helper function for returning an NVIDIA API embedding model with HTTP timeouts. """
+    return nim.with_api_timeouts(NVIDIAEmbeddings(model=model))
+
+def get_text_embedder():
+    """ This is a helper function for returning the shared, timed text embedding model. """
+    global text_embedder
+    if text_embedder is None:
+        text_embedder = metrics.TimedEmbeddings(nvidia_embeddings('NV-Embed-QA'), 'NV-Embed-QA')
+    return text_embedder
+
+def get_image_embedder():
+    """ This is a helper function for returning the shared, timed CLIP embedding model. """
+    global image_embedder
+    if image_embedder is None:
+        image_embedder = metrics.TimedEmbeddings(nvidia_embeddings('nvidia/nvclip'), 'nvidia/nvclip')
+    return image_embedder
+
+"""
+Storage layout. "collections" keeps one table per source type; "unified" writes web and pdf chunks to a
+single kb_chunks table with source_type, source_uri and ingested_at columns, searched with one ANN query.
+Images and video stay in the multimodal index either way, as they are embedded with different models.
+"""
+
+LANCEDB_STORAGE_MODE = os.environ.get("LANCEDB_STORAGE_MODE", "collections")
+UNIFIED_TABLE = "kb_chunks"
+SOURCE_TYPES = ("web", "pdf")
+
+""" LanceDB table handles shared by the searches, reopened after the knowledge base changes so they see new data,
+and again once index maintenance finishes so they see the new indexes. """
+
+_tables = {}
+_tables_kb_version = None
+
+def get_table(name: str):
+    """ This is a helper function for returning a shared handle to a LanceDB table, or None if it does not exist. """
+    global _tables, _tables_kb_version
+    if _tables_kb_version != kb_version:
+        _tables, _tables_kb_version = {}, kb_version
+    if name not in _tables:
+        if not os.path.exists(f"/project/data/lancedb/{name}.lance"):
+            return None
+        _tables[name] = lancedb.connect("/project/data/lancedb").open_table(name)
+    return _tables[name]
+
+@indexing.on_maintained
+def refresh_tables():
+    """ This is a helper function for reopening the shared table handles and multimodal stores onto the newly indexed table versions. """
+    global _tables, text_store, image_store
+    _tables = {}
+    if text_store is not None:
+        text_store = LanceDBVectorStore(uri="/project/data/lancedb", 
+                                        table_name="text_img_collection", 
+                                        embedding=get_text_embedder())
+        image_store = LanceDBVectorStore(uri="/project/data/lancedb", 
+                                         table_name="image_collection", 
+                                         embedding=get_image_embedder())
+
+def search_by_vector(name: str, vector: List[float], k: int = 3):
+    """
+    This is a helper function for searching a LangChain LanceDB collection with a precomputed query embedding.
+
+    Returns (document, score) pairs like LanceDB.similarity_search_with_score, without re-embedding the query.
+    """
+    table = get_table(name)
+    if table is None:
+        return []
+    rows = indexing.tune(table.search(vector).limit(k), name).to_list()
+    return [(_to_document(name, row), row["_distance"]) for row in rows]
+
+def search_fulltext(name: str, query: str, k: int = 3, source_types: List[str] = None):
+    """
+    This is a helper function for searching the text column of a collection with its BM25 full-text index.
+
+    Returns (document, score) pairs with higher scores better, or nothing until indexing.maintain has built the index.
+    """
+    table = get_table(name)
+    # Query syntax characters in a question would otherwise be parsed as operators by tantivy
+    terms = re.sub(r"[^\w\s]", " ", query).strip()
+    if table is None or not terms:
+        return []
+    search = table.search(terms, query_type="fts").limit(k)
+    if source_types:
+        search = search.where(_source_filter(source_types))
+    try:
+        rows = search.to_list()
+    except FileNotFoundError:
+        return []
+    return [(_to_document(name, row), row["_score"]) for row in rows]
+
+def _to_document(name: str, row):
+    if name != UNIFIED_TABLE:
+        return Document(page_content=row["text"], metadata=row.get("metadata") or {})
+    metadata = {**json.loads(row["metadata"] or "{}"), "source_type": row["source_type"], "source_uri": row["source_uri"]}
+    return Document(page_content=row["text"], metadata=metadata)
+
+def _source_filter(source_types: List[str]) -> str:
+    unknown = set(source_types) - set(SOURCE_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown source types: {sorted(unknown)}")
+    return "source_type IN ({})".format(", ".join(f"'{t}'" for t in source_types))
+
+def stored_hashes() -> set:
+    """ This is a helper function for collecting the content hashes of text chunks in the unified table. """
+    hashes = set()
+    table = get_table(UNIFIED_TABLE)
+    if table is not None:
+        for metadata in table.to_lance().to_table(columns=["metadata"]).column("metadata").to_pylist():
+            metadata = json.loads(metadata or "{}")
+            if metadata.get("content_hash"):
+                hashes.add(metadata["content_hash"])
+    return hashes
+
+def drop_collection(name: str):
+    """ This is a helper function for replacing a collection with an empty one when an upload yields no chunks. """
+    if os.path.exists(f"/project/data/lancedb/{name}.lance"):
+        lancedb.connect("/project/data/lancedb").drop_table(name)
+
+def add_chunks(doc_splits, source_type: str):
+    """ This is a helper function for appending embedded chunks of one source type to the unified table. """
+    if not doc_splits:
+        return
+    texts = [d.page_content for d in doc_splits]
+    vectors = get_text_embedder().embed_documents(texts)
+    ingested_at = datetime.datetime.now(datetime.timezone.utc)
+    rows = [{"vector": vector,
+             "text": text,
+             "source_type": source_type,
+             "source_uri": str(d.metadata.get("source", "")),
+             "ingested_at": ingested_at,
+             "metadata": json.dumps(d.metadata, default=str)} for d, text, vector in zip(doc_splits, texts, vectors)]
+    db = lancedb.connect("/project/data/lancedb")
+    if os.path.exists(f"/project/data/lancedb/{UNIFIED_TABLE}.lance"):
+        db.open_table(UNIFIED_TABLE).add(rows)
+    else:
+        db.create_table(UNIFIED_TABLE, data=rows)
+
+def search_unified(vector: List[float], k: int = 6, source_types: List[str] = None):
+    """
+    This is a helper function for searching the unified table with a single ANN query.
+
+    Args:
+        vector: The NV-Embed-QA query embedding
+        k: Number of chunks to return across all source types
+        source_types: Optional subset of SOURCE_TYPES to prefilter on
+
+    Returns:
+        (document, score) pairs, like search_by_vector
+    """
+    table = get_table(UNIFIED_TABLE)
+    if table is None:
+        return []
+    query = indexing.tune(table.search(vector).limit(k), UNIFIED_TABLE)
+    if source_types:
+        query = query.where(_source_filter(source_types), prefilter=True)
+    return [(_to_document(UNIFIED_TABLE, row), row["_distance"]) for row in query.to_list()]
+
+def search_multimodal_by_vector(text_vector: List[float], image_vector: List[float], k: int = 3):
+    """
+    This is a helper function for searching the text and image stores of the multimodal index with precomputed query embeddings.
+
+    Returns one list of scored nodes per store, as their similarities are in different embedding spaces.
+    """
+    rankings = []
+    for name, store, vector in (("text_img_collection", text_store, text_vector), ("image_collection", image_store, image_vector)):
+        params = indexing.search_params(name)
+        store.nprobes, store.refine_factor = params["nprobes"], params["refine_factor"] or None
+        result = store.query(VectorStoreQuery(query_embedding=vector, similarity_top_k=k))
+        similarities = result.similarities or [None] * len(result.nodes)
+        rankings.append([NodeWithScore(node=node, score=score) for node, score in zip(result.nodes, similarities)])
+    return rankings
 
 def download_video(url, output_path):
     """
@@ -124,10 +336,11 @@ def audio_to_text(audio_path):
 
     return text
 
+@invalidates_kb
 def upload_webpage_url(urls: List[str]):
     """ This is a helper function for parsing the user inputted URLs and uploading them into the vector store. """
     global web_vectorstore
-    docs = [WebBaseLoader(url).load() for url in urls]
+    docs = [WebBaseLoader(url, requests_kwargs={"timeout": (INGEST_CONNECT_TIMEOUT, INGEST_READ_TIMEOUT)}).load() for url in urls]
     docs_list = [item for sublist in docs for item in sublist]
     
     text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
@@ -135,15 +348,28 @@ def upload_webpage_url(urls: List[str]):
     )
     doc_splits = text_splitter.split_documents(docs_list)
     
+    if LANCEDB_STORAGE_MODE == "unified":
+        add_chunks(dedup.fingerprint(doc_splits, stored_hashes()), "web")
+        return None
+
+    # This upload replaces the web collection, so a chunk the other collection also holds must be kept here
+    # or it would vanish once that collection is replaced; such copies are collapsed at query time instead
+    doc_splits = dedup.fingerprint(doc_splits, set())
+    if not doc_splits:
+        drop_collection("web_collection")
+        web_vectorstore = None
+        return None
+
     # Add to vectorDB
     web_vectorstore = LanceDB.from_documents(
         uri="/project/data/lancedb",
         table_name="web_collection",
         documents=doc_splits,
-        embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+        embedding=get_text_embedder(),
     )
     return web_vectorstore
 
+@invalidates_kb
 def upload_pdf(pdfs: List[str]):
     """ This is a helper function for parsing the user inputted URLs and uploading them into the vector store. """
     global pdf_vectorstore
@@ -156,12 +382,24 @@ def upload_pdf(pdfs: List[str]):
     )
     doc_splits = text_splitter.split_documents(docs_list)
     
+    if LANCEDB_STORAGE_MODE == "unified":
+        add_chunks(dedup.fingerprint(doc_splits, stored_hashes()), "pdf")
+        return None
+
+    # This upload replaces the pdf collection, so a chunk the other collection also holds must be kept here
+    # or it would vanish once that collection is replaced; such copies are collapsed at query time instead
+    doc_splits = dedup.fingerprint(doc_splits, set())
+    if not doc_splits:
+        drop_collection("pdf_collection")
+        pdf_vectorstore = None
+        return None
+
     # Add to vectorDB
     pdf_vectorstore = LanceDB.from_documents(
         uri="/project/data/lancedb",
         table_name="pdf_collection",
         documents=doc_splits,
-        embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+        embedding=get_text_embedder(),
     )
     return pdf_vectorstore
 
@@ -172,6 +410,7 @@ def get_num_vids():
         count += 1
     return count
 
+@invalidates_kb
 def upload_video_url(videos: List[str]):
     """ This is a helper function for parsing the user inputted URLs and uploading them into the vector store. """
     global img_vectorstore
@@ -201,10 +440,10 @@ def upload_video_url(videos: List[str]):
 
     text_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                     table_name="text_img_collection", 
-                                    embedding=NVIDIAEmbeddings(model='NV-Embed-QA'))
+                                    embedding=get_text_embedder())
     image_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                      table_name="image_collection", 
-                                     embedding=NVIDIAEmbeddings(model='nvidia/nvclip'))
+                                     embedding=get_image_embedder())
     storage_context = StorageContext.from_defaults(
         vector_store=text_store, image_store=image_store
     )
@@ -252,9 +491,10 @@ def generate_image_description(image_b64):
         "top_p": 1.00,
         "stream": False
     }
-    response = requests.post(invoke_url, headers=headers, json=payload)
+    response = requests.post(invoke_url, headers=headers, json=payload, timeout=(INGEST_CONNECT_TIMEOUT, INGEST_READ_TIMEOUT))
     return response.json()
 
+@invalidates_kb
 def upload_image(images: List[str]):
     """ This is a helper function for parsing the user specific image file and uploading them into the vector store. """
     global img_vectorstore
@@ -276,10 +516,10 @@ def upload_image(images: List[str]):
     
     text_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                     table_name="text_img_collection", 
-                                    embedding=NVIDIAEmbeddings(model='NV-Embed-QA'))
+                                    embedding=get_text_embedder())
     image_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                      table_name="image_collection", 
-                                     embedding=NVIDIAEmbeddings(model='nvidia/nvclip'))
+                                     embedding=get_image_embedder())
     storage_context = StorageContext.from_defaults(
         vector_store=text_store, image_store=image_store
     )
@@ -293,6 +533,7 @@ def upload_image(images: List[str]):
     
     return img_vectorstore
 
+@invalidates_kb
 def upload_video(videos: List[str]):
     """ This is a helper function for parsing the user specific video file and uploading them into the vector store. """
     global img_vectorstore
@@ -322,10 +563,10 @@ def upload_video(videos: List[str]):
     
     text_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                     table_name="text_img_collection", 
-                                    embedding=NVIDIAEmbeddings(model='NV-Embed-QA'))
+                                    embedding=get_text_embedder())
     image_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                      table_name="image_collection", 
-                                     embedding=NVIDIAEmbeddings(model='nvidia/nvclip'))
+                                     embedding=get_image_embedder())
     storage_context = StorageContext.from_defaults(
         vector_store=text_store, image_store=image_store
     )
@@ -339,13 +580,14 @@ def upload_video(videos: List[str]):
     
     return img_vectorstore
 
+@invalidates_kb
 def clear():
     """ This is a helper function for emptying the collection the vector store. """
     if os.path.exists('/project/data/lancedb/web_collection.lance'):
         vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="web_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=nvidia_embeddings('NV-Embed-QA'),
         )
         
         vectorstore.delete(delete_all=True)
@@ -354,7 +596,7 @@ def clear():
         vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="pdf_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=nvidia_embeddings('NV-Embed-QA'),
         )
         
         vectorstore.delete(delete_all=True)
@@ -363,7 +605,7 @@ def clear():
         vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="text_img_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=nvidia_embeddings('NV-Embed-QA'),
         )
         
         vectorstore.delete(delete_all=True)
@@ -372,11 +614,14 @@ def clear():
         vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="image_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=nvidia_embeddings('NV-Embed-QA'),
         )
     
         vectorstore.delete(delete_all=True)
     
+    if os.path.exists(f"/project/data/lancedb/{UNIFIED_TABLE}.lance"):
+        lancedb.connect("/project/data/lancedb").drop_table(UNIFIED_TABLE)
+
     if os.path.exists("/project/data/mixed_data/"):
         shutil.rmtree("/project/data/mixed_data/")
     if os.path.exists("/project/data/video_data/"):
@@ -388,10 +633,10 @@ def initialize_img_retriever():
     if os.path.exists('/project/data/mixed_data/') and bool(os.listdir('/project/data/mixed_data/')):
         text_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                         table_name="text_img_collection", 
-                                        embedding=NVIDIAEmbeddings(model='NV-Embed-QA'))
+                                        embedding=get_text_embedder())
         image_store = LanceDBVectorStore(uri="/project/data/lancedb", 
                                          table_name="image_collection", 
-                                         embedding=NVIDIAEmbeddings(model='nvidia/nvclip'))
+                                         embedding=get_image_embedder())
         storage_context = StorageContext.from_defaults(
             vector_store=text_store, image_store=image_store
         )
@@ -421,7 +666,7 @@ def initialize_web_retriever():
         web_vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="web_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=get_text_embedder(),
         )
 
 def get_webpage_retriever(): 
@@ -436,7 +681,7 @@ def initialize_pdf_retriever():
         pdf_vectorstore = LanceDB(
             uri="/project/data/lancedb",
             table_name="pdf_collection",
-            embedding=NVIDIAEmbeddings(model='NV-Embed-QA'),
+            embedding=get_text_embedder(),
         )
 
 def get_pdf_retriever(): 
@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import re
+
+from typing import List, Set
+
+from langchain.schema import Document
+
+"""
+Chunk fingerprints for duplicate elimination.
+
+Every chunk gets a content hash of its normalized text, used at ingestion to refuse exact duplicates, and a
+64-bit SimHash over word shingles, used at query time to collapse near-duplicates (the same page crawled
+and uploaded as a pdf, or repeated transcript text) so each costs only one grader call and one prompt slot.
+Both are stored in the chunk metadata as hex strings.
+"""
+
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_MAX_HAMMING = int(os.environ.get("DEDUP_MAX_HAMMING", "6"))
+DEDUP_SHINGLE_SIZE = int(os.environ.get("DEDUP_SHINGLE_SIZE", "3"))
+
+
+def _tokens(text: str) -> List[str]:
+    return re.sub(r"[^\w\s]", " ", text.lower()).split()
+
+
+def content_hash(text: str) -> str:
+    """ Returns a hash of the text that ignores case, punctuation and whitespace. """
+    return hashlib.sha1(" ".join(_tokens(text)).encode()).hexdigest()
+
+
+def simhash(text: str) -> int:
+    """ Returns the 64-bit SimHash of the text's word shingles; similar texts differ in few bits. """
+    tokens = _tokens(text)
+    shingles = [" ".join(tokens[i:i + DEDUP_SHINGLE_SIZE]) for i in range(max(1, len(tokens) - DEDUP_SHINGLE_SIZE + 1))]
+    weights = [0] * 64
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _simhash_of(doc: Document) -> int:
+    # Chunks ingested before fingerprinting, and the multimodal index, have no stored SimHash
+    stored = (doc.metadata or {}).get("simhash")
+    return int(stored, 16) if stored else simhash(doc.page_content)
+
+
+def fingerprint(doc_splits: List[Document], stored: Set[str]) -> List[Document]:
+    """
+    Adds content_hash and simhash metadata to new chunks and drops exact duplicates.
+
+    Args:
+        doc_splits: Chunks about to be ingested
+        stored: Content hashes already in the knowledge base
+
+    Returns:
+        List[Document]: The chunks that are not duplicates of a stored chunk or of an earlier chunk in the batch
+    """
+    seen = set(stored)
+    kept = []
+    for doc in doc_splits:
+        digest = content_hash(doc.page_content)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        doc.metadata["content_hash"] = digest
+        doc.metadata["simhash"] = f"{simhash(doc.page_content):016x}"
+        kept.append(doc)
+    if len(kept) < len(doc_splits):
+        print(f"---SKIPPING {len(doc_splits) - len(kept)} DUPLICATE CHUNKS---")
+    return kept
+
+
+def collapse(documents: List[Document], max_distance: int = DEDUP_MAX_HAMMING) -> List[Document]:
+    """ Drops documents within max_distance SimHash bits of a better ranked one, keeping the ranking order. """
+    if not DEDUP_ENABLED:
+        return documents
+    kept, hashes = [], []
+    for doc in documents:
+        h = _simhash_of(doc)
+        if any(bin(h ^ other).count("1") <= max_distance for other in hashes):
+            continue
+        kept.append(doc)
+        hashes.append(h)
+    if len(kept) < len(documents):
+        print(f"---COLLAPSED {len(documents) - len(kept)} NEAR-DUPLICATE DOCUMENTS---")
+    return kept
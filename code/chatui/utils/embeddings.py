@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import os
+
+from typing import List
+
+from chatui.utils import database, metrics
+
+"""
+Query embeddings, computed once per (model, query) and kept in an LRU cache.
+
+The answer cache, the fast router and every vector search embed the same question with the same
+models, so they share these vectors instead of each making its own remote embedding call.
+"""
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+""" Query embedding models by name. The multimodal ones are whatever the image index was built with. """
+
+MODELS = {
+    "NV-Embed-QA": lambda query: database.get_text_embedder().embed_query(query),
+    # The multimodal index embeds its text nodes with its own text model and its images with CLIP
+    "multimodal-text": lambda query: metrics.embedding("multimodal-text", "query")(database.img_vectorstore._embed_model.get_query_embedding)(query),
+    "multimodal-image": lambda query: metrics.embedding("multimodal-image", "query")(database.img_vectorstore.image_embed_model.get_query_embedding)(query),
+}
+
+
+@functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _embed(model: str, query: str) -> tuple:
+    return tuple(MODELS[model](query))
+
+
+def embed_query(model: str, query: str) -> List[float]:
+    """ Returns the embedding of a query under one of MODELS, computing it only on a cache miss. """
+    return list(_embed(model, query))
+
+
+def text_query(query: str) -> List[float]:
+    """ Returns the NV-Embed-QA embedding of a query, as used by the web and pdf collections. """
+    return embed_query("NV-Embed-QA", query)
+
+
+def stats():
+    info = _embed.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
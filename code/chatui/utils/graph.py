@@ -13,10 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextvars
+import functools
 import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass
 
 from typing_extensions import TypedDict
-from typing import List
+from typing import List, Optional
 
 from chatui import ollama
 from langchain.prompts import PromptTemplate
@@ -24,13 +31,77 @@ from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from langchain_community.tools.tavily_search import TavilySearchResults
 
-from chatui.utils import database, nim
+from chatui.prompts import prompts_llama3, prompts_mistral
+from chatui.utils import cache, database, dedup, embeddings, metrics, nim, reranker, router, tracing
 
 ### State
 
 from typing import List
 from langchain.schema import Document
 
+@dataclass(frozen=True)
+class RoleConfig:
+    """
+    The resolved backend and prompt serving one agent role.
+
+    Attributes:
+        backend: "ollama", "nim" or "api"
+        endpoint: server address, empty for the API catalog
+        port: server port, empty for the API catalog
+        model: model name
+        prompt: prompt template
+    """
+
+    backend: str
+    endpoint: str
+    port: str
+    model: str
+    prompt: str
+
+    @property
+    def target(self):
+        return (self.backend, self.endpoint, self.port, self.model)
+
+
+@dataclass(frozen=True)
+class RunConfig:
+    """
+    The settings of one request, resolved once and shared read-only by every node.
+
+    Being frozen and hashable, it is referenced from the graph state rather than copied
+    into it key by key, and can be used directly as (part of) a cache key.
+
+    Attributes:
+        router, retrieval, generator, hallucination, answer: the RoleConfig of each role
+        retrieval_grading_mode: "per_document" or "single_call"
+        speculative_grading: run the answer grader alongside the hallucination grader
+        fast_router: try the embedding router before the router model
+        speculative_retrieval: retrieve while the router runs
+    """
+
+    router: RoleConfig
+    retrieval: RoleConfig
+    generator: RoleConfig
+    hallucination: RoleConfig
+    answer: RoleConfig
+    retrieval_grading_mode: str = "per_document"
+    speculative_grading: bool = False
+    fast_router: bool = True
+    speculative_retrieval: bool = False
+
+    @classmethod
+    def from_settings(cls, settings):
+        """ Resolves a RunConfig from the flat settings of the UI, keyed as in ROLES. """
+        return cls(**{role: resolve_role(settings, role) for role in ROLES},
+                   retrieval_grading_mode=settings.get("retrieval_grading_mode", "per_document"),
+                   speculative_grading=settings.get("speculative_grading", False),
+                   fast_router=settings.get("fast_router", True),
+                   speculative_retrieval=settings.get("speculative_retrieval", False))
+
+    def role(self, role):
+        return getattr(self, role)
+
+
 class GraphState(TypedDict):
     """
     Represents the state of our graph.
@@ -40,47 +111,25 @@ class GraphState(TypedDict):
         generation: LLM generation
         web_search: whether to add search
         documents: list of documents
+        config: the immutable run configuration
+        route: the routing decision
+        iterations, max_iterations, deadline: the retry budget
+        generation_grade, best_generation, best_grade, verified: grading of the generations so far
     """
 
     question: str
     generation: str
     web_search: str
     documents: List[str]
-    generator_model_id: str
-    router_model_id: str
-    retrieval_model_id: str
-    hallucination_model_id: str
-    answer_model_id: str
-    prompt_generator: str
-    prompt_router: str
-    prompt_retrieval: str
-    prompt_hallucination: str
-    prompt_answer: str
-    router_use_nim: bool
-    retrieval_use_nim: bool
-    generator_use_nim: bool
-    hallucination_use_nim: bool
-    answer_use_nim: bool
-    nim_generator_ip: str
-    nim_router_ip: str
-    nim_retrieval_ip: str
-    nim_hallucination_ip: str
-    nim_answer_ip: str
-    nim_generator_port: str
-    nim_router_port: str
-    nim_retrieval_port: str
-    nim_hallucination_port: str
-    nim_answer_port: str
-    nim_generator_id: str
-    nim_router_id: str
-    nim_retrieval_id: str
-    nim_hallucination_id: str
-    nim_answer_id: str
-    # New Ollama-specific state attributes
-    use_ollama: bool
-    ollama_server: str
-    ollama_port: str
-    ollama_model: str
+    config: RunConfig
+    route: str
+    iterations: int
+    max_iterations: int
+    deadline: float
+    generation_grade: str
+    best_generation: str
+    best_grade: str
+    verified: bool
 
 
 from langchain.schema import Document
@@ -99,55 +148,329 @@ def convert_nodes_to_documents(nodes_with_score) -> List[Document]:
     """ A helper function for converting llamaindex nodes to langchain documents. """
     return [node_to_document(node) for node in nodes_with_score]
 
-def sort_and_filter(doc_score_list):
-    # Filter out tuples with score 0.0
-    filtered_list = filter(lambda x: x[1] != 0.0, doc_score_list)
-    # Sort the list of tuples by the second element (score) in descending order
-    sorted_list = sorted(filtered_list, key=lambda x: x[1], reverse=True)
-    # Extract and return only the documents from the tuples
-    return [doc for doc, score in sorted_list]
+def reciprocal_rank_fusion(rankings, top_n: Optional[int], k: int = 60) -> List[Document]:
+    """
+    A helper function for fusing ranked document lists into one, best first.
 
-### Helper function to select the appropriate LLM based on settings
-def get_llm(state, model_key, use_nim_key, nim_ip_key, nim_port_key, nim_id_key):
+    Each document scores the sum of 1 / (k + rank) over the lists it appears in, so only ranks within a list
+    matter and distances, similarities and BM25 scores on different scales are never compared directly.
+    A top_n of None keeps every document.
     """
-    Helper function to get the appropriate LLM based on the state configuration.
-    
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(doc.page_content, doc)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)[:top_n]]
+
+### Helper functions to select and cache the appropriate LLM and chain based on settings
+
+""" Maps each agent role to its UI settings keys and the input variables of its prompt. """
+
+ROLES = {
+    "router": {
+        "model_key": "router_model_id",
+        "use_nim_key": "router_use_nim",
+        "nim_ip_key": "nim_router_ip",
+        "nim_port_key": "nim_router_port",
+        "nim_id_key": "nim_router_id",
+        "prompt_key": "prompt_router",
+        "input_variables": ["question"],
+    },
+    "retrieval": {
+        "model_key": "retrieval_model_id",
+        "use_nim_key": "retrieval_use_nim",
+        "nim_ip_key": "nim_retrieval_ip",
+        "nim_port_key": "nim_retrieval_port",
+        "nim_id_key": "nim_retrieval_id",
+        "prompt_key": "prompt_retrieval",
+        "input_variables": ["question", "document"],
+    },
+    "generator": {
+        "model_key": "generator_model_id",
+        "use_nim_key": "generator_use_nim",
+        "nim_ip_key": "nim_generator_ip",
+        "nim_port_key": "nim_generator_port",
+        "nim_id_key": "nim_generator_id",
+        "prompt_key": "prompt_generator",
+        "input_variables": ["question", "document"],
+    },
+    "hallucination": {
+        "model_key": "hallucination_model_id",
+        "use_nim_key": "hallucination_use_nim",
+        "nim_ip_key": "nim_hallucination_ip",
+        "nim_port_key": "nim_hallucination_port",
+        "nim_id_key": "nim_hallucination_id",
+        "prompt_key": "prompt_hallucination",
+        "input_variables": ["generation", "documents"],
+    },
+    "answer": {
+        "model_key": "answer_model_id",
+        "use_nim_key": "answer_use_nim",
+        "nim_ip_key": "nim_answer_ip",
+        "nim_port_key": "nim_answer_port",
+        "nim_id_key": "nim_answer_id",
+        "prompt_key": "prompt_answer",
+        "input_variables": ["generation", "question"],
+    },
+}
+
+TEMPERATURE = 0.7
+CHAIN_CACHE_SIZE = int(os.environ.get("CHAIN_CACHE_SIZE", "64"))
+
+""" Maximum number of in-flight grader calls per backend. Local Ollama serializes on one GPU, hosted endpoints scale out. """
+
+MAX_CONCURRENCY = {
+    "ollama": int(os.environ.get("OLLAMA_MAX_CONCURRENCY", "2")),
+    "nim": int(os.environ.get("NIM_MAX_CONCURRENCY", "8")),
+    "api": int(os.environ.get("API_MAX_CONCURRENCY", "8")),
+}
+
+""" Per-collection retrieval timeouts in seconds. A collection that misses its timeout is dropped from the results. """
+
+RETRIEVAL_TIMEOUTS = {
+    "web": float(os.environ.get("RETRIEVAL_TIMEOUT_WEB", "10")),
+    "pdf": float(os.environ.get("RETRIEVAL_TIMEOUT_PDF", "10")),
+    "unified": float(os.environ.get("RETRIEVAL_TIMEOUT_UNIFIED", "10")),
+    "multimodal": float(os.environ.get("RETRIEVAL_TIMEOUT_MULTIMODAL", "20")),
+}
+UNIFIED_TOP_K = int(os.environ.get("UNIFIED_TOP_K", "6"))
+
+""" Hybrid retrieval. Each text collection contributes a vector and a BM25 ranking of RETRIEVAL_CANDIDATES chunks,
+and the RETRIEVAL_TOP_N best after rank fusion are passed on to the graders. """
+
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "true").lower() == "true"
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", "5"))
+RETRIEVAL_TOP_N = int(os.environ.get("RETRIEVAL_TOP_N", "4"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+WEB_SEARCH_TIMEOUT = float(os.environ.get("WEB_SEARCH_TIMEOUT", "15"))
+
+""" Per-request budget for the generate/grade loop. When either runs out, the best generation so far is returned unverified. """
+
+GRAPH_MAX_ITERATIONS = int(os.environ.get("GRAPH_MAX_ITERATIONS", "3"))
+GRAPH_DEADLINE = float(os.environ.get("GRAPH_DEADLINE", "180"))
+
+""" Generation grades from best to worst, used to keep the best generation seen so far. """
+
+GRADE_RANK = {"useful": 2, "not useful": 1, "not supported": 0}
+
+""" Shared worker pools for work that runs alongside the calling node. """
+
+_speculative_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("SPECULATIVE_POOL_SIZE", "8")),
+                                       thread_name_prefix="speculative")
+_retrieval_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_POOL_SIZE", "8")),
+                                     thread_name_prefix="retrieval")
+_deadline_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("DEADLINE_POOL_SIZE", "16")),
+                                    thread_name_prefix="deadline")
+
+def submit_with_context(pool, fn, *args):
+    """ Runs fn(*args) on a worker pool, carrying over the caller's context (callbacks, tracing). """
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+def start_budget(state):
+    """ Returns the retry budget and deadline for a new request, keeping any the caller already supplied. """
+    return {
+        "iterations": state.get("iterations") or 0,
+        "max_iterations": state.get("max_iterations") or GRAPH_MAX_ITERATIONS,
+        "deadline": state.get("deadline") or time.monotonic() + GRAPH_DEADLINE,
+    }
+
+def remaining_time(state):
+    """ Returns the seconds left before the request deadline, or None if no deadline is set. """
+    if not state.get("deadline"):
+        return None
+    return max(0.0, state["deadline"] - time.monotonic())
+
+def call_with_deadline(state, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) within the time left before the request deadline, raising TimeoutError once it runs out.
+
+    The request stops waiting at the deadline; the call itself is only stopped by its client's HTTP timeouts.
+    """
+    remaining = remaining_time(state)
+    if remaining is None:
+        return fn(*args, **kwargs)
+    # A call submitted after the deadline would start at once and could no longer be cancelled
+    if remaining <= 0:
+        raise TimeoutError("request deadline has passed")
+    future = submit_with_context(_deadline_pool, functools.partial(fn, *args, **kwargs))
+    try:
+        return future.result(timeout=remaining)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+def get_grade(score):
+    """ This is a helper function for normalizing a grader's yes/no verdict. """
+    return str(score.get("score", "")).strip().lower() if isinstance(score, dict) else ""
+
+def resolve_role(settings, role):
+    """
+    Helper function to resolve which backend and prompt serve a role from the UI settings.
+
     Args:
-        state: The current state dictionary
-        model_key: Key for the model ID in the state
-        use_nim_key: Key for the flag indicating whether to use NIM
-        nim_ip_key: Key for the NIM IP address
-        nim_port_key: Key for the NIM port
-        nim_id_key: Key for the NIM model ID
-        
+        settings: The flat settings dictionary, keyed as in ROLES
+        role: One of the keys of ROLES
+
     Returns:
-        An instance of the appropriate LLM class
+        A RoleConfig, where backend is "ollama", "nim" or "api"
     """
+    keys = ROLES[role]
+    prompt = settings[keys["prompt_key"]]
     # If Ollama is enabled, use that
-    if state.get("use_ollama", False):
+    if settings.get("use_ollama", False):
+        return RoleConfig("ollama", settings["ollama_server"], settings["ollama_port"], settings["ollama_model"], prompt)
+    # Otherwise, use NIM or NVIDIA API as before
+    elif settings[keys["use_nim_key"]]:
+        return RoleConfig("nim",
+                          settings[keys["nim_ip_key"]],
+                          settings[keys["nim_port_key"]] if len(settings[keys["nim_port_key"]]) > 0 else "8000",
+                          settings[keys["nim_id_key"]] if len(settings[keys["nim_id_key"]]) > 0 else "meta/llama3-8b-instruct",
+                          prompt)
+    else:
+        return RoleConfig("api", "", "", settings[keys["model_key"]], prompt)
+
+def resolve_backend(state, role):
+    """
+    Helper function to return which backend serves a role for the current state.
+
+    Returns:
+        A (backend, endpoint, port, model) tuple, where backend is "ollama", "nim" or "api"
+    """
+    return state["config"].role(role).target
+
+@functools.lru_cache(maxsize=CHAIN_CACHE_SIZE)
+def _build_llm(backend, endpoint, port, model, temperature):
+    """ Constructs (once per configuration) the LLM client for a resolved backend. """
+    if backend == "ollama":
         return ollama.OllamaChatModel(
-            ollama_server=state["ollama_server"],
-            ollama_port=state["ollama_port"],
-            model_name=state["ollama_model"],
-            temperature=0.7
+            ollama_server=endpoint,
+            ollama_port=port,
+            model_name=model,
+            temperature=temperature
         )
-    # Otherwise, use NIM or NVIDIA API as before
-    elif state[use_nim_key]:
+    elif backend == "nim":
         return nim.CustomChatOpenAI(
-            custom_endpoint=state[nim_ip_key], 
-            port=state[nim_port_key] if len(state[nim_port_key]) > 0 else "8000",
-            model_name=state[nim_id_key] if len(state[nim_id_key]) > 0 else "meta/llama3-8b-instruct",
-            temperature=0.7
+            custom_endpoint=endpoint, 
+            port=port,
+            model_name=model,
+            temperature=temperature
         )
     else:
-        return ChatNVIDIA(model=state[model_key], temperature=0.7)
+        return nim.with_api_timeouts(ChatNVIDIA(model=model, temperature=temperature))
+
+@functools.lru_cache(maxsize=CHAIN_CACHE_SIZE)
+def _build_chain(role, backend, endpoint, port, model, temperature, prompt, input_variables, parser):
+    """ Constructs (once per configuration) the prompt | llm | parser runnable for a role, tagged, metered and traced by role and backend. """
+    prompt_template = PromptTemplate(
+        template=prompt,
+        input_variables=list(input_variables),
+    )
+    return (prompt_template | _build_llm(backend, endpoint, port, model, temperature) | parser()).with_config(
+        tags=[role],
+        metadata={"role": role, "backend": backend, "model": model, "endpoint": endpoint, "port": port},
+        callbacks=[metrics.llm_handler, tracing.llm_handler],
+    )
+
+def get_llm(state, role):
+    """
+    Helper function to get the appropriate LLM based on the run configuration.
+    
+    Args:
+        state: The current state dictionary
+        role: One of the keys of ROLES
+        
+    Returns:
+        A cached instance of the appropriate LLM class
+    """
+    return _build_llm(*resolve_backend(state, role), TEMPERATURE)
+
+def get_chain(state, role, parser, prompt=None, input_variables=None):
+    """
+    Helper function to get the ready-built chain for a role based on the run configuration.
+
+    Chains are memoized on (role, backend, endpoint, port, model, temperature, prompt, parser),
+    so prompt parsing and client construction happen once per configuration rather than on
+    every node execution.
+
+    Args:
+        state: The current state dictionary
+        role: One of the keys of ROLES
+        parser: The output parser class to terminate the chain with
+        prompt: Optional prompt overriding the role's prompt from the run configuration
+        input_variables: Input variables of the overriding prompt
+
+    Returns:
+        A cached prompt | llm | parser runnable
+    """
+    if prompt is None:
+        prompt = state["config"].role(role).prompt
+        input_variables = ROLES[role]["input_variables"]
+    return _build_chain(role, *resolve_backend(state, role), TEMPERATURE, prompt, tuple(input_variables), parser)
 
 ### Nodes
 
+def fulltext_ranking(name, label, question, k):
+    """
+    Returns the BM25 ranking of a text collection, or an empty one if its full-text index cannot be searched,
+    e.g. while it is stale after an overwrite and indexing.maintain has yet to rebuild it.
+    """
+    try:
+        return [doc for doc, score in metrics.fulltext(label)(database.search_fulltext)(name, question, k=k)]
+    except Exception as e:
+        print(f"---FULL-TEXT SEARCH OF {name.upper()} FAILED ({e}), USING VECTOR RESULTS ONLY---")
+        return []
+
+def hybrid_search(name, label, question, vector, k):
+    """ Returns the vector ranking of a text collection and, with hybrid search on, its BM25 ranking, each timed under label. """
+    rankings = [[doc for doc, distance in metrics.search(label)(database.search_by_vector)(name, vector, k=k)]]
+    if HYBRID_SEARCH:
+        rankings.append(fulltext_ranking(name, label, question, k))
+    return rankings
+
+@tracing.traced("retrieve.web")
+def retrieve_webpages(question, vector):
+    """ Searches the webpage collection with the question's text embedding and terms. """
+    print("---RETRIEVING WEBPAGES---")
+    return hybrid_search("web_collection", "web", question, vector, RETRIEVAL_CANDIDATES)
+
+@tracing.traced("retrieve.pdf")
+def retrieve_pdfs(question, vector):
+    """ Searches the pdf collection with the question's text embedding and terms. """
+    print("---RETRIEVING PDFS---")
+    return hybrid_search("pdf_collection", "pdf", question, vector, RETRIEVAL_CANDIDATES)
+
+@tracing.traced("retrieve.unified")
+def retrieve_unified(question, vector):
+    """ Searches web and pdf chunks in the unified table with a single ANN query, plus a single BM25 query. """
+    print("---RETRIEVING WEBPAGES AND PDFS---")
+    rankings = [[doc for doc, distance in metrics.search("unified")(database.search_unified)(vector, k=UNIFIED_TOP_K)]]
+    if HYBRID_SEARCH:
+        rankings.append(fulltext_ranking(database.UNIFIED_TABLE, "unified", question, UNIFIED_TOP_K))
+    return rankings
+
+@tracing.traced("retrieve.multimodal")
+def retrieve_multimodal(question, vector):
+    """ Searches the image and video collections with the question's multimodal text and CLIP embeddings. """
+    print("---RETRIEVING IMAGES AND VIDEO---")
+    text_vector = embeddings.embed_query("multimodal-text", question)
+    image_vector = embeddings.embed_query("multimodal-image", question)
+    nodes_per_store = metrics.search("multimodal")(database.search_multimodal_by_vector)(text_vector, image_vector, k=RETRIEVAL_CANDIDATES)
+    # convert_nodes_to_documents returns (document, score) pairs; the rankings hold documents only
+    return [[doc for doc, score in convert_nodes_to_documents(nodes)] for nodes in nodes_per_store]
+
+@metrics.node("retrieve")
+@tracing.traced("retrieve")
 def retrieve(state):
     """
     Retrieve documents from vectorstore
 
+    The question is embedded once per model and the vectors are shared by every collection,
+    which are then searched concurrently, each bounded by its RETRIEVAL_TIMEOUTS entry.
+    A collection that times out or errors is skipped so the others can still be used.
+    Their vector and full-text rankings are fused, near-duplicates are collapsed and only the RETRIEVAL_TOP_N best are kept,
+    unless the rerank stage follows, in which case it gets the whole pool and makes the cut itself.
+
     Args:
         state (dict): The current graph state
 
@@ -157,36 +480,86 @@ def retrieve(state):
     print("---RETRIEVE---")
     question = state["question"]
 
-    webpages = []
-    pdfs = []
-    images = []
-
     # Retrieval
-    
-    if os.path.exists('/project/data/lancedb/web_collection.lance'):
-        print("---RETRIEVING WEBPAGES---")
-        web_retriever = database.get_webpage_retriever()
-        webpages = web_retriever.similarity_search_with_score(question, k=3)
-    if os.path.exists('/project/data/lancedb/pdf_collection.lance'):
-        print("---RETRIEVING PDFS---")
-        pdf_retriever = database.get_pdf_retriever()
-        pdfs = pdf_retriever.similarity_search_with_score(question, k=3)
+    searches = {}
+    if database.LANCEDB_STORAGE_MODE == "unified":
+        if os.path.exists(f'/project/data/lancedb/{database.UNIFIED_TABLE}.lance'):
+            searches["unified"] = retrieve_unified
+    else:
+        if os.path.exists('/project/data/lancedb/web_collection.lance'):
+            searches["web"] = retrieve_webpages
+        if os.path.exists('/project/data/lancedb/pdf_collection.lance'):
+            searches["pdf"] = retrieve_pdfs
     if os.path.exists('/project/data/lancedb/text_img_collection.lance') and os.path.exists("/project/data/mixed_data/"):
-        print("---RETRIEVING IMAGES AND VIDEO---")
-        img_retriever = database.get_img_retriever()
-        images = convert_nodes_to_documents(img_retriever.retrieve(question))
+        searches["multimodal"] = retrieve_multimodal
+
+    start = time.monotonic()
+    # The multimodal search embeds with its own models on its worker; web and pdf share one text embedding
+    text_vector = None
+    if searches.keys() & {"web", "pdf", "unified"}:
+        try:
+            text_vector = embeddings.text_query(question)
+        except Exception as e:
+            print(f"---QUERY EMBEDDING FAILED ({e}), SKIPPING WEB AND PDF COLLECTIONS---")
+            for name in ("web", "pdf", "unified"):
+                searches.pop(name, None)
+    futures = {name: submit_with_context(_retrieval_pool, search, question, text_vector) for name, search in searches.items()}
+    rankings = []
+    for name, future in futures.items():
+        try:
+            rankings += future.result(timeout=max(0.0, start + RETRIEVAL_TIMEOUTS[name] - time.monotonic()))
+        except TimeoutError:
+            future.cancel()
+            print(f"---RETRIEVAL FROM {name.upper()} TIMED OUT, CONTINUING WITH PARTIAL RESULTS---")
+        except Exception as e:
+            print(f"---RETRIEVAL FROM {name.upper()} FAILED ({e}), CONTINUING WITH PARTIAL RESULTS---")
     
-    print("---RERANKING RETRIEVED DOCUMENTS---")
-    documents = sort_and_filter(webpages + pdfs + images)
+    print("---FUSING RETRIEVED RANKINGS---")
+    documents = dedup.collapse(reciprocal_rank_fusion(rankings, None, RRF_K))
+    if not reranker.enabled():
+        documents = documents[:RETRIEVAL_TOP_N]
     return {"documents": documents, "question": question}
 
 
-def generate(state):
+@metrics.node("rerank")
+@tracing.traced("rerank")
+def rerank(state):
+    """
+    Rerank retrieved documents with a local cross-encoder, pruning those unlikely to pass grading.
+
+    Only part of the graph when reranker.enabled(); a reranker failure passes the documents through unchanged.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Updates documents key with the top reranked documents
+    """
+    print("---RERANK---")
+    question = state["question"]
+    documents = state["documents"]
+    try:
+        reranked = reranker.rerank(question, documents)
+    except Exception as e:
+        print(f"---RERANK FAILED ({e}), GRADING ALL RETRIEVED DOCUMENTS---")
+        return {"documents": documents}
+    print(f"---RERANK: KEPT {len(reranked)} OF {len(documents)} DOCUMENTS---")
+    tracing.set_attribute("rerank.kept", len(reranked))
+    return {"documents": reranked}
+
+
+@metrics.node("generate")
+@tracing.traced("generate")
+def generate(state, config):
     """
     Generate answer using RAG on retrieved documents
 
+    The generation is streamed so that callbacks passed to the graph receive tokens, tagged
+    "generator", as they are produced.
+
     Args:
         state (dict): The current graph state
+        config (RunnableConfig): The graph run configuration, carrying its callbacks
 
     Returns:
         state (dict): New key added to state, generation, that contains LLM generation
@@ -196,25 +569,30 @@ def generate(state):
     documents = state["documents"]
 
     # RAG generation
-    prompt = PromptTemplate(
-        template=state["prompt_generator"],
-        input_variables=["question", "document"],
-    )
-    
-    llm = get_llm(
-        state,
-        "generator_model_id", 
-        "generator_use_nim", 
-        "nim_generator_ip", 
-        "nim_generator_port", 
-        "nim_generator_id"
-    )
-    
-    rag_chain = prompt | llm | StrOutputParser()
-    generation = rag_chain.invoke({"context": documents, "question": question})
-    return {"documents": documents, "question": question, "generation": generation}
+    if state.get("iterations", 0) > 0:
+        metrics.RETRIES.labels(role="generator", backend=resolve_backend(state, "generator")[0], reason="regenerate").inc()
+    rag_chain = get_chain(state, "generator", StrOutputParser)
+    chunks, stop = [], threading.Event()
+
+    def _stream():
+        for chunk in rag_chain.stream({"context": documents, "question": question}, config=config):
+            if stop.is_set():
+                break
+            chunks.append(chunk)
 
+    try:
+        call_with_deadline(state, _stream)
+    except TimeoutError:
+        # Closing the stream early drops the connection instead of generating tokens nobody will read
+        stop.set()
+        print("---GENERATION HIT THE REQUEST DEADLINE, KEEPING THE PARTIAL ANSWER---")
+    generation = "".join(chunks)
+    return {"documents": documents, "question": question, "generation": generation,
+            "iterations": state.get("iterations", 0) + 1}
 
+
+@metrics.node("grade_documents")
+@tracing.traced("grade_documents")
 def grade_documents(state):
     """
     Determines whether the retrieved documents are relevant to the question
@@ -234,28 +612,18 @@ def grade_documents(state):
     # Score each doc
     filtered_docs = []
     web_search = "No"
-    prompt = PromptTemplate(
-        template=state["prompt_retrieval"],
-        input_variables=["question", "document"],
-    )
-    
-    llm = get_llm(
-        state,
-        "retrieval_model_id", 
-        "retrieval_use_nim", 
-        "nim_retrieval_ip", 
-        "nim_retrieval_port", 
-        "nim_retrieval_id"
-    )
-    
-    retrieval_grader = prompt | llm | JsonOutputParser()
-    for d in documents:
-        score = retrieval_grader.invoke(
-            {"question": question, "document": d.page_content}
-        )
-        grade = score["score"]
+    grades = None
+    if state["config"].retrieval_grading_mode == "single_call" and len(documents) > 1:
+        if uses_default_retrieval_prompt(state):
+            grades = grade_documents_single_call(state, question, documents)
+        else:
+            print("---GRADE: RETRIEVAL PROMPT WAS EDITED, GRADING PER DOCUMENT TO USE IT---")
+    if grades is None:
+        grades = grade_documents_per_document(state, question, documents)
+
+    for d, grade in zip(documents, grades):
         # Document relevant
-        if grade.lower() == "yes":
+        if grade:
             print("---GRADE: DOCUMENT RELEVANT---")
             filtered_docs.append(d)
         # Document not relevant
@@ -268,6 +636,80 @@ def grade_documents(state):
     return {"documents": filtered_docs, "question": question, "web_search": web_search}
 
 
+def uses_default_router_prompt(state):
+    """ Returns whether the router prompt is an unedited default, the only kind the fast router's exemplars reflect. """
+    prompt = state["config"].router.prompt.strip()
+    return prompt in (prompts_llama3.router_prompt.strip(), prompts_mistral.router_prompt.strip())
+
+
+def uses_default_retrieval_prompt(state):
+    """ Returns whether the retrieval grader prompt is an unedited default, the only kind with a matching batch prompt. """
+    prompt = state["config"].retrieval.prompt.strip()
+    return prompt in (prompts_llama3.retrieval_prompt.strip(), prompts_mistral.retrieval_prompt.strip())
+
+
+def grade_documents_per_document(state, question, documents):
+    """
+    Grades each document with its own retrieval grader call, fanned out concurrently.
+
+    Returns:
+        List[bool]: Relevance verdicts in the original ranking order
+    """
+    retrieval_grader = get_chain(state, "retrieval", JsonOutputParser)
+    backend = resolve_backend(state, "retrieval")[0]
+
+    # Grade all documents concurrently; batch() returns scores in the original ranking order
+    try:
+        scores = call_with_deadline(state, retrieval_grader.batch,
+                                    [{"question": question, "document": d.page_content} for d in documents],
+                                    config={"max_concurrency": MAX_CONCURRENCY[backend]},
+                                    return_exceptions=True)
+    except TimeoutError:
+        print("---GRADE: DOCUMENT GRADING HIT THE REQUEST DEADLINE, KEEPING DOCUMENTS UNGRADED---")
+        return [True] * len(documents)
+    grades = []
+    for score in scores:
+        if isinstance(score, Exception):
+            print("---GRADE: DOCUMENT GRADING FAILED, TREATING AS NOT RELEVANT---")
+            grades.append(False)
+        else:
+            grades.append(get_grade(score) == "yes")
+    return grades
+
+
+def grade_documents_single_call(state, question, documents):
+    """
+    Grades all documents with a single retrieval grader call over a numbered prompt.
+
+    Returns:
+        List[bool]: Relevance verdicts in the original ranking order, or None if the
+        response could not be parsed and per-document grading should be used instead
+    """
+    model = resolve_backend(state, "retrieval")[3]
+    prompts = prompts_mistral if ("mistral" in model or "mixtral" in model) else prompts_llama3
+    retrieval_grader = get_chain(state,
+                                 "retrieval",
+                                 JsonOutputParser,
+                                 prompt=prompts.retrieval_batch_prompt,
+                                 input_variables=["question", "documents", "count"])
+    numbered = "\n\n".join(f"Document {i + 1}:\n{d.page_content}" for i, d in enumerate(documents))
+    try:
+        scores = call_with_deadline(state, retrieval_grader.invoke,
+                                    {"question": question, "documents": numbered, "count": len(documents)})["scores"]
+        if not isinstance(scores, list) or len(scores) != len(documents):
+            raise ValueError(f"expected {len(documents)} scores, got {scores}")
+        return [str(score).lower() == "yes" for score in scores]
+    except TimeoutError:
+        print("---GRADE: DOCUMENT GRADING HIT THE REQUEST DEADLINE, KEEPING DOCUMENTS UNGRADED---")
+        return [True] * len(documents)
+    except Exception as e:
+        print(f"---GRADE: SINGLE CALL GRADING FAILED ({e}), FALLING BACK TO PER DOCUMENT---")
+        metrics.RETRIES.labels(role="retrieval", backend=resolve_backend(state, "retrieval")[0], reason="single_call_fallback").inc()
+        return None
+
+
+@metrics.node("websearch")
+@tracing.traced("websearch")
 def web_search(state):
     """
     Web search based based on the question
@@ -286,7 +728,19 @@ def web_search(state):
     # Web search
     if len(question) > 4: # Tavily minimum search length is 5 characters
         web_search_tool = TavilySearchResults(k=3)
-        docs = web_search_tool.invoke({"query": question})
+        timeout = WEB_SEARCH_TIMEOUT
+        if remaining_time(state) is not None:
+            timeout = min(timeout, remaining_time(state))
+        search_future = submit_with_context(_speculative_pool, tracing.traced("websearch.tavily")(web_search_tool.invoke), {"query": question})
+        try:
+            docs = search_future.result(timeout=timeout)
+        except TimeoutError:
+            search_future.cancel()
+            print("---WEB SEARCH TIMED OUT, CONTINUING WITHOUT WEB RESULTS---")
+            return {"documents": documents or [], "question": question}
+        if not isinstance(docs, list):
+            print(f"---WEB SEARCH FAILED ({docs}), CONTINUING WITHOUT WEB RESULTS---")
+            return {"documents": documents or [], "question": question}
         web_results = "\n".join([d["content"] for d in docs])
         web_results = Document(page_content=web_results)
         if documents is not None:
@@ -296,9 +750,64 @@ def web_search(state):
     return {"documents": documents, "question": question}
 
 
+@metrics.node("route")
+@tracing.traced("route")
+def route(state):
+    """
+    Route the question, optionally retrieving from the vectorstore while the router runs.
+
+    With speculative retrieval on, retrieval starts at the same moment as the router call so their
+    latencies overlap. The prefetched documents are kept if the router picks the vectorstore and
+    discarded if it picks web search.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): New key added to state, route, with the routing decision, plus the prefetched documents if any
+    """
+
+    budget = start_budget(state)
+    state = {**state, **budget}
+    if not state["config"].speculative_retrieval:
+        return {"route": route_question(state), **budget}
+
+    print("---SPECULATIVE RETRIEVAL---")
+    retrieval_future = submit_with_context(_speculative_pool, retrieve, state)
+    try:
+        decision = route_question(state)
+    except Exception:
+        retrieval_future.cancel()
+        raise
+    if decision != "vectorstore":
+        retrieval_future.cancel()
+        print("---DISCARDING SPECULATIVE RETRIEVAL---")
+        return {"route": decision, **budget}
+    return {"route": decision, "documents": retrieval_future.result()["documents"], **budget}
+
+
 ### Conditional edge
 
 
+def decide_to_retrieve(state):
+    """
+    Determines whether to web search, retrieve, or grade documents that were already retrieved
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+
+    if state["route"] != "vectorstore":
+        return "websearch"
+    if state["config"].speculative_retrieval:
+        print("---USING SPECULATIVELY RETRIEVED DOCUMENTS---")
+        return "grade_documents"
+    return "retrieve"
+
+
 def route_question(state):
     """
     Route question to web search or RAG.
@@ -313,29 +822,42 @@ def route_question(state):
     print("---ROUTE QUESTION---")
     question = state["question"]
     print(question)
-    prompt = PromptTemplate(
-        template=state["prompt_router"],
-        input_variables=["question"],
-    )
-    
-    llm = get_llm(
-        state,
-        "router_model_id", 
-        "router_use_nim", 
-        "nim_router_ip", 
-        "nim_router_port", 
-        "nim_router_id"
-    )
-    
-    question_router = prompt | llm | JsonOutputParser()
-    source = question_router.invoke({"question": question})
-    print(source)
-    if source["datasource"] == "web_search":
+    route_key = (cache.normalize_question(question), state["config"].router)
+    datasource = cache.route_cache.get(route_key)
+    tracing.set_attribute("route_cache.hit", datasource is not None)
+    if datasource is not None:
+        print(f"---ROUTE CACHE HIT: {datasource}---")
+    elif state["config"].fast_router and uses_default_router_prompt(state):
+        try:
+            datasource = router.fast_route(question)
+        except Exception as e:
+            print(f"---FAST ROUTER FAILED ({e}), DEFERRING TO LLM ROUTER---")
+        if datasource is not None:
+            print(f"---FAST ROUTER DECISION: {datasource}---")
+            tracing.set_attribute("fast_router.hit", True)
+    if datasource is None:
+        question_router = get_chain(state, "router", JsonOutputParser)
+        try:
+            source = call_with_deadline(state, question_router.invoke, {"question": question})
+            print(source)
+            datasource = str(source.get("datasource", "")).strip().lower() if isinstance(source, dict) else None
+            # Decisions made under an edited prompt would teach the fast router that prompt's routing
+            if uses_default_router_prompt(state):
+                router.log_decision(question, datasource)
+        except TimeoutError:
+            print("---ROUTER HIT THE REQUEST DEADLINE---")
+    if datasource in ("web_search", "vectorstore"):
+        cache.route_cache.put(route_key, datasource)
+    tracing.set_attribute("route.datasource", str(datasource))
+    if datasource == "web_search":
         print("---ROUTE QUESTION TO WEB SEARCH---")
         return "websearch"
-    elif source["datasource"] == "vectorstore":
+    elif datasource == "vectorstore":
         print("---ROUTE QUESTION TO RAG---")
         return "vectorstore"
+    else:
+        print(f"---UNKNOWN DATASOURCE {datasource}, ROUTE QUESTION TO RAG---")
+        return "vectorstore"
 
 
 def decide_to_generate(state):
@@ -386,50 +908,28 @@ def grade_generation_v_documents_and_question(state):
     documents = state["documents"]
     generation = state["generation"]
 
-    prompt = PromptTemplate(
-        template=state["prompt_hallucination"],
-        input_variables=["generation", "documents"],
-    )
-    
-    llm_hallucination = get_llm(
-        state,
-        "hallucination_model_id", 
-        "hallucination_use_nim", 
-        "nim_hallucination_ip", 
-        "nim_hallucination_port", 
-        "nim_hallucination_id"
-    )
-    
-    hallucination_grader = prompt | llm_hallucination | JsonOutputParser()
+    hallucination_grader = get_chain(state, "hallucination", JsonOutputParser)
+    answer_grader = get_chain(state, "answer", JsonOutputParser)
 
-    score = hallucination_grader.invoke(
-        {"documents": documents, "generation": generation}
-    )
-    grade = score["score"]
+    # In speculative mode the answer grader starts now instead of waiting on the hallucination verdict
+    answer_future = None
+    if state["config"].speculative_grading and remaining_time(state) != 0:
+        print("---GRADE GENERATION vs QUESTION (SPECULATIVE)---")
+        answer_future = submit_with_context(_speculative_pool, answer_grader.invoke, {"question": question, "generation": generation})
+
+    score = call_with_deadline(state, hallucination_grader.invoke, {"documents": documents, "generation": generation})
+    grade = get_grade(score)
 
     # Check hallucination
-    prompt = PromptTemplate(
-        template=state["prompt_answer"],
-        input_variables=["generation", "question"],
-    )
-    
-    llm_answer = get_llm(
-        state,
-        "answer_model_id", 
-        "answer_use_nim", 
-        "nim_answer_ip", 
-        "nim_answer_port", 
-        "nim_answer_id"
-    )
-    
-    answer_grader = prompt | llm_answer | JsonOutputParser()
-    
     if grade == "yes":
         print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
         # Check question-answering
-        print("---GRADE GENERATION vs QUESTION---")
-        score = answer_grader.invoke({"question": question, "generation": generation})
-        grade = score["score"]
+        if answer_future is not None:
+            score = answer_future.result(timeout=remaining_time(state))
+        else:
+            print("---GRADE GENERATION vs QUESTION---")
+            score = call_with_deadline(state, answer_grader.invoke, {"question": question, "generation": generation})
+        grade = get_grade(score)
         if grade == "yes":
             print("---DECISION: GENERATION ADDRESSES QUESTION---")
             return "useful"
@@ -437,5 +937,92 @@ def grade_generation_v_documents_and_question(state):
             print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
             return "not useful"
     else:
+        # The speculative answer grade is not needed; drop it if it has not started yet
+        if answer_future is not None:
+            answer_future.cancel()
         print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
-        return "not supported"
\ No newline at end of file
+        return "not supported"
+
+
+### Nodes
+
+
+@metrics.node("grade_generation")
+@tracing.traced("grade_generation")
+def grade_generation(state):
+    """
+    Grade the generation and keep track of the best generation so far
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): New keys added to state, generation_grade and verified, plus the best generation and its grade
+    """
+
+    generation = state["generation"]
+    try:
+        grade = grade_generation_v_documents_and_question(state)
+    except TimeoutError:
+        # decide_after_grading then sees the deadline has passed and finalizes the best generation unverified
+        print("---GRADING HIT THE REQUEST DEADLINE---")
+        grade = "not supported"
+    best_generation, best_grade = state.get("best_generation"), state.get("best_grade")
+    if best_grade is None or GRADE_RANK[grade] > GRADE_RANK[best_grade]:
+        best_generation, best_grade = generation, grade
+    return {"generation": generation,
+            "generation_grade": grade,
+            "best_generation": best_generation,
+            "best_grade": best_grade,
+            "verified": grade == "useful"}
+
+
+@metrics.node("finalize")
+@tracing.traced("finalize")
+def finalize(state):
+    """
+    Return the best generation so far, tagged as unverified, once the retry budget or deadline is exhausted
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Updates generation with the tagged best generation
+    """
+
+    print("---FINALIZE UNVERIFIED GENERATION---")
+    if state.get("iterations", 0) >= state.get("max_iterations", GRAPH_MAX_ITERATIONS):
+        reason = f"retry budget of {state.get('max_iterations', GRAPH_MAX_ITERATIONS)} generations exhausted"
+    else:
+        reason = "request deadline exceeded"
+    generation = state.get("best_generation") or state["generation"]
+    if not generation:
+        generation = "No answer could be generated in time."
+    return {"generation": f"{generation}\n\n*Unverified: {reason} before the answer passed grading.*",
+            "verified": False}
+
+
+### Conditional edge
+
+
+def decide_after_grading(state):
+    """
+    Determines whether to finish, retry, or give up once the retry budget or deadline is exhausted
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        str: Decision for next node to call
+    """
+
+    grade = state["generation_grade"]
+    if grade == "useful":
+        return "useful"
+    if state.get("iterations", 0) >= state.get("max_iterations", GRAPH_MAX_ITERATIONS):
+        print("---DECISION: RETRY BUDGET EXHAUSTED---")
+        return "exhausted"
+    if remaining_time(state) == 0:
+        print("---DECISION: DEADLINE EXCEEDED---")
+        return "exhausted"
+    return grade
@@ -0,0 +1,302 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+
+import lancedb
+import numpy as np
+
+"""
+ANN index maintenance for the knowledge base tables.
+
+Tables are searched by brute-force scan until they pass INDEX_MIN_ROWS, then get an IVF_PQ (or IVF_HNSW_*)
+index on their vector column. Rows ingested afterwards are folded into the existing index with optimize(),
+and the index is retrained from scratch once the table has grown by INDEX_RETRAIN_GROWTH since it was
+trained, as the partitions no longer fit the data. The text tables also get a BM25 full-text index for
+hybrid retrieval, rebuilt whenever the table is written to. Run as a module to maintain or benchmark the indexes:
+
+    python -m chatui.utils.indexing maintain
+    python -m chatui.utils.indexing benchmark pdf_collection --k 10 --nprobes 1,5,10,20,50 --refine 0,10
+"""
+
+LANCEDB_URI = "/project/data/lancedb"
+INDEXED_TABLES = ["web_collection", "pdf_collection", "kb_chunks", "text_img_collection", "image_collection"]
+FTS_TABLES = ["web_collection", "pdf_collection", "kb_chunks"]
+
+INDEX_ENABLED = os.environ.get("INDEX_ENABLED", "true").lower() == "true"
+INDEX_MIN_ROWS = int(os.environ.get("INDEX_MIN_ROWS", "50000"))
+INDEX_TYPE = os.environ.get("INDEX_TYPE", "IVF_PQ")
+INDEX_METRIC = os.environ.get("INDEX_METRIC", "L2")
+INDEX_RETRAIN_GROWTH = float(os.environ.get("INDEX_RETRAIN_GROWTH", "2.0"))
+INDEX_STATE_PATH = os.environ.get("INDEX_STATE_PATH", f"{LANCEDB_URI}/index_state.json")
+
+""" Search parameters applied to every ANN query, overridable per table with INDEX_SEARCH_PARAMS, e.g.
+'{"pdf_collection": {"nprobes": 40, "refine_factor": 10}}'. A refine factor of 0 disables refinement. """
+
+INDEX_NPROBES = int(os.environ.get("INDEX_NPROBES", "20"))
+INDEX_REFINE_FACTOR = int(os.environ.get("INDEX_REFINE_FACTOR", "0"))
+INDEX_SEARCH_PARAMS = json.loads(os.environ.get("INDEX_SEARCH_PARAMS", "{}"))
+
+_lock = threading.Lock()
+_running = False
+_dirty = False
+
+""" Called after every maintenance pass. Table handles stay on the dataset version they opened, so whoever
+holds long-lived handles registers here to reopen them onto the indexed version. """
+
+_listeners = []
+
+
+def on_maintained(fn):
+    """ Registers fn to be called with no arguments after each maintenance pass. Usable as a decorator. """
+    _listeners.append(fn)
+    return fn
+
+
+def search_params(name: str) -> dict:
+    """ Returns the nprobes and refine_factor to search a table with. """
+    params = {"nprobes": INDEX_NPROBES, "refine_factor": INDEX_REFINE_FACTOR}
+    params.update(INDEX_SEARCH_PARAMS.get(name, {}))
+    return params
+
+
+def tune(query, name: str):
+    """ Applies a table's search parameters to a LanceDB vector query. They are ignored by a brute-force scan. """
+    params = search_params(name)
+    query = query.nprobes(params["nprobes"])
+    if params["refine_factor"]:
+        query = query.refine_factor(params["refine_factor"])
+    return query
+
+
+def _load_state():
+    if not os.path.exists(INDEX_STATE_PATH):
+        return {}
+    with open(INDEX_STATE_PATH) as f:
+        return json.load(f)
+
+
+def _save_state(state):
+    with open(INDEX_STATE_PATH, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def _has_vector_index(table) -> bool:
+    return any("vector" in index.columns for index in table.list_indices())
+
+
+def _num_sub_vectors(dim: int) -> int:
+    # Sub-vectors of 16 (or failing that 8) dimensions keep PQ both accurate and SIMD friendly
+    for width in (16, 8, 4, 2, 1):
+        if dim % width == 0:
+            return dim // width
+
+
+def build_index(table, rows: int):
+    """ This is a helper function for training a new vector index over the whole table, replacing any existing one. """
+    dim = table.schema.field("vector").type.list_size
+    num_partitions = max(1, min(int(math.sqrt(rows)), rows // 256))
+    table.create_index(metric=INDEX_METRIC,
+                       num_partitions=num_partitions,
+                       num_sub_vectors=_num_sub_vectors(dim),
+                       vector_column_name="vector",
+                       replace=True,
+                       index_type=INDEX_TYPE)
+    return {"index_type": INDEX_TYPE, "num_partitions": num_partitions, "trained_rows": rows, "indexed_rows": rows}
+
+
+def maintain_fts(name: str, state: dict):
+    """
+    Rebuilds the full-text index of one table if it was written to since the index was built.
+
+    Returns:
+        str: The action taken, for logging
+    """
+    if not os.path.exists(f"{LANCEDB_URI}/{name}.lance"):
+        return "missing"
+    table = lancedb.connect(LANCEDB_URI).open_table(name)
+    # Any add or overwrite creates a new table version, whereas the tantivy index lives beside the dataset
+    if state.get(name, {}).get("version") == table.version:
+        return "up to date"
+    table.create_fts_index("text", replace=True)
+    state[name] = {"version": table.version}
+    return f"built full-text index over {table.count_rows()} rows"
+
+
+def maintain_table(name: str, state: dict):
+    """
+    Builds, extends or retrains the vector index of one table as needed.
+
+    Returns:
+        str: The action taken, for logging
+    """
+    if not os.path.exists(f"{LANCEDB_URI}/{name}.lance"):
+        return "missing"
+    table = lancedb.connect(LANCEDB_URI).open_table(name)
+    rows = table.count_rows()
+    if rows < INDEX_MIN_ROWS:
+        return "below threshold"
+    entry = state.get(name)
+    # A table that was dropped and recreated loses its index, and one that shrank needs new partitions
+    if entry is None or not _has_vector_index(table) or rows < entry["indexed_rows"] \
+            or rows >= entry["trained_rows"] * INDEX_RETRAIN_GROWTH:
+        state[name] = build_index(table, rows)
+        return f"built {INDEX_TYPE} over {rows} rows"
+    if rows > entry["indexed_rows"]:
+        table.optimize()
+        added, entry["indexed_rows"] = rows - entry["indexed_rows"], rows
+        return f"added {added} rows to index"
+    return "up to date"
+
+
+def maintain(names=None):
+    """
+    Maintains the vector and full-text indexes of the given tables, by default all knowledge base tables.
+
+    Returns:
+        dict: The action taken per table and index kind
+    """
+    state = _load_state()
+    report = {}
+    for name in names or INDEXED_TABLES:
+        jobs = [("vector", maintain_table)] + ([("fts", maintain_fts)] if name in FTS_TABLES else [])
+        for kind, job in jobs:
+            try:
+                report[f"{name}.{kind}"] = job(name, state.setdefault(kind, {}))
+            except Exception as e:
+                report[f"{name}.{kind}"] = f"failed ({e})"
+            print(f"---INDEX {name} ({kind.upper()}): {report[f'{name}.{kind}'].upper()}---")
+    _save_state(state)
+    return report
+
+
+def _maintenance_loop():
+    global _running, _dirty
+    while True:
+        maintain()
+        for listener in _listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f"---INDEX LISTENER FAILED: {e}---")
+        with _lock:
+            if not _dirty:
+                _running = False
+                return
+            _dirty = False
+
+
+def schedule_maintenance():
+    """ Runs maintain() on a daemon thread; a request made while it is running queues one more pass. """
+    global _running, _dirty
+    if not INDEX_ENABLED:
+        return
+    with _lock:
+        if _running:
+            _dirty = True
+            return
+        _running = True
+    threading.Thread(target=_maintenance_loop, daemon=True, name="index-maintenance").start()
+
+
+def benchmark(name: str, k: int = 10, num_queries: int = 100, nprobes=(1, 5, 10, 20, 50), refine_factors=(0, 10), table=None):
+    """
+    Measures recall@k and latency of ANN search on a table against an exact scan.
+
+    Queries are vectors sampled from the table itself, and the exact neighbours are computed in memory,
+    so the table must fit in memory. Results are matched by vector, as not every table has an id column.
+    Pass the app's own handle, e.g. database.get_table(name), as table to check that the searches the app
+    makes see the index; the "app search" row runs them with the tuned parameters.
+
+    Returns:
+        list: One dict per (nprobes, refine_factor) setting, plus the exact scan and the app search
+    """
+    if table is None:
+        table = lancedb.connect(LANCEDB_URI).open_table(name)
+    vectors = np.asarray(table.to_lance().to_table(columns=["vector"]).column("vector").to_pylist(), dtype=np.float32)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+
+    truth, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        nearest = np.argpartition(((vectors - query) ** 2).sum(axis=1), min(k, len(vectors) - 1))[:k]
+        latencies.append(time.perf_counter() - start)
+        truth.append({vectors[i].tobytes() for i in nearest})
+    results = [{"setting": "exact scan", "recall": 1.0, **_percentiles(latencies)}]
+
+    indexed = _has_vector_index(table)
+    for n in nprobes if indexed else (None,):
+        for refine in refine_factors if indexed else (None,):
+            recalls, latencies = [], []
+            for query, expected in zip(queries, truth):
+                search = table.search(query).limit(k).select(["vector"])
+                if n is not None:
+                    search = search.nprobes(n)
+                if refine:
+                    search = search.refine_factor(refine)
+                start = time.perf_counter()
+                rows = search.to_list()
+                latencies.append(time.perf_counter() - start)
+                found = {np.asarray(row["vector"], dtype=np.float32).tobytes() for row in rows}
+                recalls.append(len(found & expected) / len(expected))
+            setting = f"nprobes={n} refine={refine}" if indexed else "lancedb flat"
+            results.append({"setting": setting, "recall": float(np.mean(recalls)), **_percentiles(latencies)})
+
+    recalls, latencies = [], []
+    for query, expected in zip(queries, truth):
+        search = tune(table.search(query).limit(k).select(["vector"]), name)
+        start = time.perf_counter()
+        rows = search.to_list()
+        latencies.append(time.perf_counter() - start)
+        found = {np.asarray(row["vector"], dtype=np.float32).tobytes() for row in rows}
+        recalls.append(len(found & expected) / len(expected))
+    setting = f"app search ({'indexed' if indexed else 'flat'})"
+    results.append({"setting": setting, "recall": float(np.mean(recalls)), **_percentiles(latencies)})
+    return results
+
+
+def _percentiles(latencies):
+    return {"p50_ms": float(np.percentile(latencies, 50) * 1000), "p95_ms": float(np.percentile(latencies, 95) * 1000)}
+
+
+def _csv(cast):
+    return lambda value: tuple(cast(v) for v in value.split(",") if v)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain or benchmark the knowledge base vector indexes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    maintain_parser = commands.add_parser("maintain", help="build or update the vector and full-text indexes")
+    maintain_parser.add_argument("tables", nargs="*", help="tables to maintain, by default all of them")
+    bench_parser = commands.add_parser("benchmark", help="report recall versus latency for a table")
+    bench_parser.add_argument("table")
+    bench_parser.add_argument("--k", type=int, default=10)
+    bench_parser.add_argument("--queries", type=int, default=100)
+    bench_parser.add_argument("--nprobes", type=_csv(int), default=(1, 5, 10, 20, 50))
+    bench_parser.add_argument("--refine", type=_csv(int), default=(0, 10))
+    args = parser.parse_args()
+
+    if args.command == "maintain":
+        maintain(args.tables)
+    else:
+        print(f"{'setting':<28}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for result in benchmark(args.table, args.k, args.queries, args.nprobes, args.refine):
+            print(f"{result['setting']:<28}{result['recall']:>10.3f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}")
@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import threading
+import time
+
+from typing import List
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+"""
+Prometheus metrics for the agentic graph: per-node latency, LLM calls by role and backend,
+embedding calls, and vector and full-text searches. Served as text by api.create_app on /metrics.
+Not covered: embeddings computed by llama_index inside MultiModalVectorStoreIndex while ingesting
+images and video, as the index calls its own embedding models.
+"""
+
+""" Latency buckets in seconds, wide enough for a cold model load on a local backend. """
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, float("inf"))
+SIZE_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, float("inf"))
+
+NODE_LATENCY = Histogram("chatui_node_latency_seconds", "Latency of graph nodes", ["node"], buckets=LATENCY_BUCKETS)
+NODE_ERRORS = Counter("chatui_node_errors_total", "Graph nodes that raised", ["node"])
+
+LLM_LATENCY = Histogram("chatui_llm_latency_seconds", "Latency of LLM calls", ["role", "backend"], buckets=LATENCY_BUCKETS)
+LLM_CALLS = Counter("chatui_llm_calls_total", "LLM calls by outcome", ["role", "backend", "status"])
+LLM_PROMPT_CHARS = Histogram("chatui_llm_prompt_chars", "Prompt size of LLM calls in characters", ["role", "backend"], buckets=SIZE_BUCKETS)
+LLM_COMPLETION_CHARS = Histogram("chatui_llm_completion_chars", "Completion size of LLM calls in characters", ["role", "backend"], buckets=SIZE_BUCKETS)
+LLM_TOKENS = Counter("chatui_llm_tokens_total", "Tokens reported by the backend", ["role", "backend", "kind"])
+RETRIES = Counter("chatui_retries_total", "Repeated or fallback LLM work", ["role", "backend", "reason"])
+
+EMBED_LATENCY = Histogram("chatui_embedding_latency_seconds", "Latency of embedding calls", ["model", "kind"], buckets=LATENCY_BUCKETS)
+EMBED_ERRORS = Counter("chatui_embedding_errors_total", "Embedding calls that raised", ["model", "kind"])
+SEARCH_LATENCY = Histogram("chatui_vector_search_latency_seconds", "Latency of vector searches", ["collection"], buckets=LATENCY_BUCKETS)
+SEARCH_ERRORS = Counter("chatui_vector_search_errors_total", "Vector searches that raised", ["collection"])
+FULLTEXT_LATENCY = Histogram("chatui_fulltext_search_latency_seconds", "Latency of BM25 full-text searches", ["collection"], buckets=LATENCY_BUCKETS)
+FULLTEXT_ERRORS = Counter("chatui_fulltext_search_errors_total", "Full-text searches that raised", ["collection"])
+
+
+def _timed(histogram, errors, **labels):
+    """ Decorator recording the latency, and any exception, of each call under the given labels. """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                errors.labels(**labels).inc()
+                raise
+            finally:
+                histogram.labels(**labels).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def node(name: str):
+    """ Decorator timing a graph node. functools.wraps keeps the signature LangGraph inspects for a config parameter. """
+    return _timed(NODE_LATENCY, NODE_ERRORS, node=name)
+
+
+def search(collection: str):
+    """ Decorator timing a vector search over a collection. """
+    return _timed(SEARCH_LATENCY, SEARCH_ERRORS, collection=collection)
+
+
+def fulltext(collection: str):
+    """ Decorator timing a full-text search over a collection. """
+    return _timed(FULLTEXT_LATENCY, FULLTEXT_ERRORS, collection=collection)
+
+
+def embedding(model: str, kind: str):
+    """ Decorator timing an embedding call of a model that is not a LangChain Embeddings, e.g. a llama_index one. """
+    return _timed(EMBED_LATENCY, EMBED_ERRORS, model=model, kind=kind)
+
+
+class TimedEmbeddings(Embeddings):
+    """ Wraps an embedding model to time its calls. """
+
+    def __init__(self, embeddings: Embeddings, model: str):
+        self.embeddings = embeddings
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return _timed(EMBED_LATENCY, EMBED_ERRORS, model=self.model, kind="documents")(self.embeddings.embed_documents)(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return _timed(EMBED_LATENCY, EMBED_ERRORS, model=self.model, kind="query")(self.embeddings.embed_query)(text)
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """
+    A callback handler recording latency, outcome and sizes of LLM calls.
+
+    Role and backend are read from the run metadata set by graph._build_chain.
+    """
+
+    def __init__(self):
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, metadata, prompt_chars):
+        metadata = metadata or {}
+        labels = {"role": metadata.get("role", "unknown"), "backend": metadata.get("backend", "unknown")}
+        LLM_PROMPT_CHARS.labels(**labels).observe(prompt_chars)
+        with self._lock:
+            self._runs[run_id] = (time.perf_counter(), labels)
+
+    def _finish(self, run_id, status):
+        with self._lock:
+            start, labels = self._runs.pop(run_id, (None, None))
+        if start is None:
+            return None
+        LLM_LATENCY.labels(**labels).observe(time.perf_counter() - start)
+        LLM_CALLS.labels(status=status, **labels).inc()
+        return labels
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata, sum(len(p) for p in prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, metadata, sum(len(str(m.content)) for batch in messages for m in batch))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        labels = self._finish(run_id, "ok")
+        if labels is None:
+            return
+        LLM_COMPLETION_CHARS.labels(**labels).observe(sum(len(g.text) for batch in response.generations for g in batch))
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                LLM_TOKENS.labels(kind=kind.split("_")[0], **labels).inc(usage[kind])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error")
+
+
+llm_handler = LLMMetricsHandler()
+
+
+def render():
+    """ Returns the current metrics in the Prometheus text format, with its content type. """
+    return generate_latest(), CONTENT_TYPE_LATEST
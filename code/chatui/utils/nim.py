@@ -16,8 +16,101 @@
 from langchain_openai import ChatOpenAI
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.load.dump import dumps
+from langchain_core.messages import ChatMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
 from pydantic import Field
-from typing import List, Mapping, Optional, Any
+from typing import AsyncIterator, Iterator, List, Mapping, Optional, Any
+
+import asyncio
+import functools
+import json
+import os
+import weakref
+
+import httpx
+import requests
+
+from chatui.utils import tracing
+import openai
+
+""" Connection pool settings for the NIM clients. Override with environment variables. """
+
+NIM_POOL_SIZE = int(os.environ.get("NIM_POOL_SIZE", "20"))
+NIM_CONNECT_TIMEOUT = float(os.environ.get("NIM_CONNECT_TIMEOUT", "5"))
+NIM_READ_TIMEOUT = float(os.environ.get("NIM_READ_TIMEOUT", "120"))
+NIM_MAX_RETRIES = int(os.environ.get("NIM_MAX_RETRIES", "2"))
+
+""" Timeouts for the NVIDIA API catalog clients (ChatNVIDIA, NVIDIAEmbeddings), which otherwise set none. """
+
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", "120"))
+
+_async_clients = weakref.WeakKeyDictionary()
+
+def _base_url(endpoint: str, port: str) -> str:
+    return "http://" + endpoint + ":" + port + "/v1/"
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=NIM_POOL_SIZE, max_keepalive_connections=NIM_POOL_SIZE)
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(NIM_READ_TIMEOUT, connect=NIM_CONNECT_TIMEOUT)
+
+@functools.lru_cache(maxsize=None)
+def get_client(endpoint: str, port: str) -> openai.OpenAI:
+    """
+    Return the pooled OpenAI client for a NIM endpoint, creating it on first use.
+
+    Each (endpoint, port) gets its own client and connection pool, so sessions pointing
+    at different NIMs never share or overwrite each other's settings.
+    """
+    return openai.OpenAI(
+        api_key="xyz",
+        base_url=_base_url(endpoint, port),
+        timeout=_timeout(),
+        max_retries=NIM_MAX_RETRIES,
+        http_client=httpx.Client(limits=_limits(), timeout=_timeout(), event_hooks=tracing.httpx_event_hooks()),
+    )
+
+def get_async_client(endpoint: str, port: str) -> openai.AsyncOpenAI:
+    """
+    Return the pooled async OpenAI client for a NIM endpoint on the running event loop.
+
+    The underlying httpx client is bound to the loop it was created on, so clients are
+    cached per loop and dropped together with it.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (endpoint, port)
+    if key not in clients:
+        clients[key] = openai.AsyncOpenAI(
+            api_key="xyz",
+            base_url=_base_url(endpoint, port),
+            timeout=_timeout(),
+            max_retries=NIM_MAX_RETRIES,
+            http_client=httpx.AsyncClient(limits=_limits(), timeout=_timeout(), event_hooks=tracing.httpx_event_hooks(asynchronous=True)),
+        )
+    return clients[key]
+
+class TimeoutSession(requests.Session):
+    """ A requests session that applies the API timeouts to every request not setting its own, and traces it. """
+
+    def __init__(self):
+        super().__init__()
+        self.hooks["response"].append(tracing.requests_response_hook)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+def with_api_timeouts(component):
+    """
+    Makes a ChatNVIDIA or NVIDIAEmbeddings instance open its HTTP sessions with the API timeouts.
+
+    langchain_nvidia_ai_endpoints posts without a timeout through sessions from its client's get_session_fn.
+    """
+    component._client.get_session_fn = TimeoutSession
+    return component
 
 class CustomChatOpenAI(BaseChatModel):
     """ This is a custom built class for using LangChain to chat with custom OpenAI API-compatible endpoints, eg. NIMs. """
@@ -39,22 +132,62 @@ class CustomChatOpenAI(BaseChatModel):
         return 'llama'
         
     def _generate(self, messages, stop=None, run_manager=None, **kwargs):
-        response = self._call_custom_endpoint(messages)
+        response = self._call_custom_endpoint(messages, stop=stop)
         return self._create_chat_result(response)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        stream = get_client(self.custom_endpoint, self.port).chat.completions.create(
+            model=self.model_name,
+            messages=self._convert_messages(messages),
+            temperature=self.temperature,
+            stop=stop or openai.NOT_GIVEN,
+            stream=True,
+        )
+        for part in stream:
+            token = part.choices[0].delta.content if part.choices else None
+            if token:
+                chunk = ChatGenerationChunk(message=ChatMessageChunk(content=token, role="assistant"))
+                if run_manager:
+                    run_manager.on_llm_new_token(token, chunk=chunk)
+                yield chunk
     
-    def _call_custom_endpoint(self, messages, **kwargs):
-        import openai
-        import json
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        client = get_async_client(self.custom_endpoint, self.port)
+        response = await client.chat.completions.create(
+            model=self.model_name,
+            messages=self._convert_messages(messages),
+            temperature=self.temperature,
+            stop=stop or openai.NOT_GIVEN,
+        )
+        return self._create_chat_result(response)
 
-        openai.api_key = "xyz"
-        openai.base_url = "http://" + self.custom_endpoint + ":" + self.port + "/v1/"
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        client = get_async_client(self.custom_endpoint, self.port)
+        stream = await client.chat.completions.create(
+            model=self.model_name,
+            messages=self._convert_messages(messages),
+            temperature=self.temperature,
+            stop=stop or openai.NOT_GIVEN,
+            stream=True,
+        )
+        async for part in stream:
+            token = part.choices[0].delta.content if part.choices else None
+            if token:
+                chunk = ChatGenerationChunk(message=ChatMessageChunk(content=token, role="assistant"))
+                if run_manager:
+                    await run_manager.on_llm_new_token(token, chunk=chunk)
+                yield chunk
 
+    def _convert_messages(self, messages):
         obj = json.loads(dumps(messages))
-        
-        response = openai.chat.completions.create(
+        return [{"role": "user", "content": obj[0]["kwargs"]["content"]}]
+
+    def _call_custom_endpoint(self, messages, stop=None, **kwargs):
+        response = get_client(self.custom_endpoint, self.port).chat.completions.create(
             model=self.model_name,
-            messages=[{"role": "user", "content": obj[0]["kwargs"]["content"]}], 
+            messages=self._convert_messages(messages), 
             temperature=self.temperature,
+            stop=stop or openai.NOT_GIVEN,
         )
         return response
     
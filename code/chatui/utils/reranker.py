@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+from typing import List
+
+from langchain.schema import Document
+
+from chatui.utils import cache
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+"""
+Optional local reranking of retrieved chunks before they are graded by the retrieval LLM.
+
+With the stage on, retrieve hands over its whole fused candidate pool instead of cutting it to
+RETRIEVAL_TOP_N. A small cross-encoder scores every (question, chunk) pair in one batched CPU forward pass,
+and only the RERANK_TOP_K best chunks scoring at least RERANK_CUTOFF are passed on, so the grader makes fewer calls.
+Scores are cached per pair. Requires sentence-transformers (pip install sentence-transformers); without it,
+or with RERANK_ENABLED unset, the graph skips the stage.
+"""
+
+RERANK_ENABLED = os.environ.get("RERANK_ENABLED", "false").lower() == "true"
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_TOP_K = int(os.environ.get("RERANK_TOP_K", "3"))
+RERANK_CUTOFF = float(os.environ.get("RERANK_CUTOFF", "0.01"))
+RERANK_BATCH_SIZE = int(os.environ.get("RERANK_BATCH_SIZE", "16"))
+RERANK_MAX_LENGTH = int(os.environ.get("RERANK_MAX_LENGTH", "512"))
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", "4096"))
+
+_model = None
+_lock = threading.Lock()
+
+""" Scores by (question, chunk text). The model is fixed for the life of the process, so entries never go stale. """
+
+scores = cache.TTLCache(RERANK_CACHE_SIZE, float("inf"))
+
+
+if RERANK_ENABLED and CrossEncoder is None:
+    print("---RERANKER REQUESTED BUT SENTENCE-TRANSFORMERS IS NOT INSTALLED, SKIPPING---")
+
+
+def enabled() -> bool:
+    """ Returns whether the reranking stage is part of the graph. """
+    return RERANK_ENABLED and CrossEncoder is not None
+
+
+def get_model():
+    """ Loads the cross-encoder on first use. """
+    global _model
+    with _lock:
+        if _model is None:
+            _model = CrossEncoder(RERANK_MODEL, device="cpu", max_length=RERANK_MAX_LENGTH)
+    return _model
+
+
+def score(question: str, documents: List[Document]) -> List[float]:
+    """ Returns the relevance score of each document to the question, scoring cache misses in one batch. """
+    cached = [scores.get((question, d.page_content)) for d in documents]
+    missing = [d.page_content for d, s in zip(documents, cached) if s is None]
+    if missing:
+        predicted = get_model().predict([(question, text) for text in missing], batch_size=RERANK_BATCH_SIZE, show_progress_bar=False)
+        fresh = dict(zip(missing, (float(s) for s in predicted)))
+        for text, value in fresh.items():
+            scores.put((question, text), value)
+        cached = [fresh[d.page_content] if s is None else s for d, s in zip(documents, cached)]
+    return cached
+
+
+def rerank(question: str, documents: List[Document], top_k: int = RERANK_TOP_K, cutoff: float = RERANK_CUTOFF) -> List[Document]:
+    """
+    Reorders documents by cross-encoder score, keeping at most top_k that score at least cutoff.
+
+    Returns:
+        List[Document]: The kept documents, best first
+    """
+    if not documents:
+        return []
+    ranked = sorted(zip(score(question, documents), documents), key=lambda pair: pair[0], reverse=True)
+    return [d for s, d in ranked if s >= cutoff][:top_k]
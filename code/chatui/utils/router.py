@@ -0,0 +1,188 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+
+from typing import Optional
+
+import numpy as np
+
+from chatui.prompts import defaults
+from chatui.utils import database, embeddings
+
+"""
+A local, embedding-based router that decides between the vectorstore and web search without an LLM call.
+
+The question embedding is compared against labeled exemplar queries and the centroids of the knowledge
+base collections. Confident decisions are returned immediately; ambiguous ones return None so the caller
+can defer to the LLM router, whose decisions are logged and used as additional exemplars once the router
+retrains: at warmup, and in the background after every ROUTER_RETRAIN_EVERY logged decisions.
+"""
+
+ROUTER_DECISION_LOG = os.environ.get("ROUTER_DECISION_LOG", "/project/data/router_decisions.jsonl")
+ROUTER_MIN_SIMILARITY = float(os.environ.get("ROUTER_MIN_SIMILARITY", "0.5"))
+ROUTER_MIN_MARGIN = float(os.environ.get("ROUTER_MIN_MARGIN", "0.08"))
+ROUTER_MAX_LOGGED_EXEMPLARS = int(os.environ.get("ROUTER_MAX_LOGGED_EXEMPLARS", "500"))
+ROUTER_CENTROID_SAMPLE = int(os.environ.get("ROUTER_CENTROID_SAMPLE", "2000"))
+ROUTER_RETRAIN_EVERY = int(os.environ.get("ROUTER_RETRAIN_EVERY", "50"))
+
+""" Knowledge base collections embedded with the same model as the question, used to build centroids. """
+
+CENTROID_COLLECTIONS = ["web_collection", "pdf_collection", database.UNIFIED_TABLE]
+
+_lock = threading.Lock()
+_exemplars = None
+_centroids = None
+_centroids_kb_version = None
+_training = threading.Lock()
+_decisions_since_train = 0
+_vectors = {}
+
+
+def _normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _read_logged_decisions():
+    """ Returns the most recent (question, datasource) pairs decided by the LLM router. """
+    if not os.path.exists(ROUTER_DECISION_LOG):
+        return []
+    decisions = []
+    with open(ROUTER_DECISION_LOG, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("source", "llm") == "llm" and record.get("datasource") in ("vectorstore", "web_search"):
+                decisions.append((record["question"], record["datasource"]))
+    return decisions[-ROUTER_MAX_LOGGED_EXEMPLARS:]
+
+
+def train():
+    """
+    (Re)builds the exemplar set from the default exemplars and the logged LLM routing decisions.
+
+    Returns:
+        dict: Number of exemplars per datasource
+    """
+    global _exemplars
+    with _training:
+        labeled = {label: list(queries) for label, queries in defaults.router_exemplars.items()}
+        for question, datasource in _read_logged_decisions():
+            labeled.setdefault(datasource, []).append(question)
+
+        # Exemplars go through the batched passage endpoint; every label is embedded the same way, so their
+        # similarities to the query stay comparable with each other. Vectors are kept, so a retrain only embeds new exemplars.
+        new = sorted({query for queries in labeled.values() for query in queries} - _vectors.keys())
+        if new:
+            _vectors.update(zip(new, _normalize(database.get_text_embedder().embed_documents(new))))
+        exemplars = {label: np.stack([_vectors[query] for query in queries]) for label, queries in labeled.items() if queries}
+        with _lock:
+            _exemplars = exemplars
+    return {label: len(vectors) for label, vectors in exemplars.items()}
+
+
+def _train_quietly():
+    try:
+        print(f"---ROUTER TRAINED ON {train()} EXEMPLARS---")
+    except Exception as e:
+        print(f"---ROUTER TRAINING FAILED ({e})---")
+
+
+def train_in_background():
+    """ Runs train() on a daemon thread, unless a training is already running. """
+    if not _training.locked():
+        threading.Thread(target=_train_quietly, daemon=True, name="router-train").start()
+
+
+def _get_exemplars():
+    # Training embeds hundreds of exemplars, so it never runs on a request; until it is done, defer to the LLM
+    if _exemplars is None:
+        train_in_background()
+    return _exemplars
+
+
+def _get_centroids():
+    """ Returns normalized centroids of the knowledge base collections, recomputed when the knowledge base changes. """
+    global _centroids, _centroids_kb_version
+    kb_version = database.get_kb_version()
+    if _centroids is not None and _centroids_kb_version == kb_version:
+        return _centroids
+    centroids = []
+    for name in CENTROID_COLLECTIONS:
+        table = database.get_table(name)
+        if table is None:
+            continue
+        vectors = table.head(ROUTER_CENTROID_SAMPLE).column("vector").to_pylist()
+        if vectors:
+            centroids.append(np.mean(_normalize(vectors), axis=0))
+    with _lock:
+        _centroids = _normalize(centroids) if centroids else None
+        _centroids_kb_version = kb_version
+    return _centroids
+
+
+def fast_route(question: str) -> Optional[str]:
+    """
+    Routes a question using embeddings only.
+
+    Args:
+        question (str): The user question
+
+    Returns:
+        str: "vectorstore" or "web_search" when confident, otherwise None to defer to the LLM router
+    """
+    vector = _normalize(embeddings.text_query(question))[0]
+    exemplars = _get_exemplars()
+    if exemplars is None:
+        return None
+    scores = {label: float(np.max(vectors @ vector)) for label, vectors in exemplars.items() if vectors.shape[1] == vector.shape[0]}
+
+    centroids = _get_centroids()
+    if centroids is not None and centroids.shape[1] == vector.shape[0]:
+        scores["vectorstore"] = max(scores.get("vectorstore", -1.0), float(np.max(centroids @ vector)))
+
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    if not ranked or ranked[0][1] < ROUTER_MIN_SIMILARITY:
+        return None
+    margin = ranked[0][1] - (ranked[1][1] if len(ranked) > 1 else -1.0)
+    if margin < ROUTER_MIN_MARGIN:
+        return None
+    return ranked[0][0]
+
+
+def log_decision(question: str, datasource: str, source: str = "llm"):
+    """ Appends a routing decision to the decision log so it can be used by train(), retraining every ROUTER_RETRAIN_EVERY decisions. """
+    global _decisions_since_train
+    try:
+        with _lock, open(ROUTER_DECISION_LOG, "a") as f:
+            f.write(json.dumps({"question": question, "datasource": datasource, "source": source, "time": time.time()}) + "\n")
+    except OSError as e:
+        print(f"Could not log routing decision: {e}")
+        return
+    with _lock:
+        _decisions_since_train += 1
+        retrain = _decisions_since_train >= ROUTER_RETRAIN_EVERY
+        if retrain:
+            _decisions_since_train = 0
+    if retrain:
+        train_in_background()
@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextvars
+import queue
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from chatui.utils import tracing
+
+""" Streams generator tokens out of the agentic graph while the rest of the graph keeps running. """
+
+TOKEN = "token"
+NODE = "node"
+ERROR = "error"
+DONE = "done"
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """ A callback handler that forwards tokens from LLM runs carrying the given tag onto a queue. """
+
+    def __init__(self, events: queue.Queue, tag: str):
+        self.events = events
+        self.tag = tag
+
+    def on_llm_new_token(self, token: str, *, tags=None, **kwargs):
+        if self.tag in (tags or []):
+            self.events.put((TOKEN, token))
+
+
+def stream_graph(app, inputs, tag: str = "generator", span=None):
+    """
+    Runs the graph on a background thread and yields its events in order.
+
+    If span is given, the graph's spans are recorded as its children.
+
+    Yields:
+        (TOKEN, str) for each token from an LLM run tagged with tag,
+        (NODE, dict) for each completed node, and (ERROR, Exception) if the graph fails.
+    """
+    events = queue.Queue()
+    handler = TokenQueueHandler(events, tag)
+
+    def _run():
+        try:
+            with tracing.use_span(span):
+                for output in app.stream(inputs, {"callbacks": [handler]}):
+                    events.put((NODE, output))
+        except Exception as e:
+            events.put((ERROR, e))
+        finally:
+            events.put((DONE, None))
+
+    threading.Thread(target=contextvars.copy_context().run, args=(_run,), daemon=True).start()
+    while True:
+        event = events.get()
+        if event[0] == DONE:
+            return
+        yield event
@@ -0,0 +1,412 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+
+import requests
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+"""
+Request tracing: one trace per chat request, with child spans for graph nodes, retrieval per collection,
+LLM calls (so each per-document grade is its own span), web search and outbound HTTP calls.
+
+The current span is held in a context variable, so spans nest across the graph's worker threads as long as
+work is submitted with the caller's context (see graph.submit_with_context). Finished spans go to every
+registered exporter; a JSONL exporter and an OTLP/HTTP (JSON encoding) exporter are provided.
+"""
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() == "true"
+TRACE_EXPORTERS = [e.strip() for e in os.environ.get("TRACE_EXPORTERS", "jsonl").split(",") if e.strip()]
+TRACE_JSONL_PATH = os.environ.get("TRACE_JSONL_PATH", "/project/data/traces.jsonl")
+TRACE_JSONL_MAX_BYTES = int(os.environ.get("TRACE_JSONL_MAX_BYTES", str(50 * 1024 * 1024)))
+OTLP_ENDPOINT = os.environ.get("OTLP_ENDPOINT", "http://localhost:4318")
+OTLP_SERVICE_NAME = os.environ.get("OTLP_SERVICE_NAME", "chatui")
+TRACE_HISTORY = int(os.environ.get("TRACE_HISTORY", "20"))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """ A timed operation within a trace. Times are in nanoseconds since the epoch. """
+
+    def __init__(self, name, trace_id=None, parent=None, start_ns=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id or (parent.trace_id if parent else secrets.token_hex(16))
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes)
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end_ns=None, error=None):
+        self.end_ns = end_ns or time.time_ns()
+        self.error = str(error) if error is not None else None
+        _export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+### Exporters
+
+
+class BackgroundExporter(abc.ABC):
+    """
+    Base for exporters that write spans in batches from a background thread, so exporting never blocks a request.
+
+    Subclasses implement write(spans). Spans are dropped if the queue is full or the write fails.
+    """
+
+    def __init__(self, name: str, batch_size: int = 64, interval: float = 2.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._run, daemon=True, name=name).start()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    @abc.abstractmethod
+    def write(self, spans):
+        """ Writes a batch of spans; called only from the background thread. """
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(spans) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    spans.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write(spans)
+            except Exception as e:
+                print(f"Could not export {len(spans)} trace spans: {e}")
+
+
+class JsonlExporter(BackgroundExporter):
+    """ Appends finished spans as JSON lines to a local file, rotated to a single .1 backup once it passes max_bytes. """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        super().__init__("jsonl-exporter")
+
+    def write(self, spans):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPExporter(BackgroundExporter):
+    """
+    Sends spans to an OpenTelemetry collector over OTLP/HTTP with JSON encoding.
+
+    Spans are dropped if the collector is unreachable.
+    """
+
+    def __init__(self, endpoint: str, service_name: str, batch_size: int = 64, interval: float = 2.0):
+        self.url = f"{endpoint.rstrip('/')}/v1/traces"
+        self.service_name = service_name
+        super().__init__("otlp-exporter", batch_size, interval)
+
+    def _payload(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": "chatui"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                    "name": span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                } for span in spans],
+            }],
+        }]}
+
+    def write(self, spans):
+        requests.post(self.url, json=self._payload(spans), timeout=(2, 5)).raise_for_status()
+
+
+class RecentTraces:
+    """ Keeps the spans of the last few traces in memory for the Monitor tab. """
+
+    def __init__(self, max_traces: int):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self._traces.setdefault(span.trace_id, []).append(span)
+            self._traces.move_to_end(span.trace_id)
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def last(self):
+        with self._lock:
+            return list(next(reversed(self._traces.values()), []))
+
+
+recent_traces = RecentTraces(TRACE_HISTORY)
+_exporters = [recent_traces]
+
+
+def register_exporter(exporter):
+    """ Adds an exporter; any object with an export(span) method. """
+    _exporters.append(exporter)
+
+
+def _export(span: Span):
+    if not TRACING_ENABLED:
+        return
+    for exporter in _exporters:
+        try:
+            exporter.export(span)
+        except Exception as e:
+            print(f"Trace exporter {type(exporter).__name__} failed: {e}")
+
+
+if TRACING_ENABLED:
+    if "jsonl" in TRACE_EXPORTERS:
+        register_exporter(JsonlExporter(TRACE_JSONL_PATH, TRACE_JSONL_MAX_BYTES))
+    if "otlp" in TRACE_EXPORTERS:
+        register_exporter(OTLPExporter(OTLP_ENDPOINT, OTLP_SERVICE_NAME))
+
+
+### Instrumentation
+
+
+def current_span():
+    return _current_span.get()
+
+
+def set_attribute(key, value):
+    """ Sets an attribute on the current span, if any. """
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ Runs the enclosed block as a child of the current span, or as a new trace if there is none. """
+    if not TRACING_ENABLED:
+        yield None
+        return
+    current = Span(name, parent=_current_span.get(), **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=e)
+        raise
+    else:
+        current.end()
+    finally:
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def use_span(parent):
+    """ Makes an existing span current for the enclosed block without ending it, e.g. a request span on a worker thread. """
+    token = _current_span.set(parent)
+    try:
+        yield parent
+    finally:
+        _current_span.reset(token)
+
+
+def traced(name):
+    """ Decorator running each call in its own span. """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_http(method, url, status, start_ns, end_ns=None, error=None):
+    """ Records an already completed outbound HTTP call as a child of the current span. """
+    if not TRACING_ENABLED or _current_span.get() is None:
+        return
+    http_span = Span(f"HTTP {method}", parent=_current_span.get(), start_ns=start_ns,
+                     **{"http.method": method, "http.url": str(url), "http.status_code": status})
+    http_span.end(end_ns=end_ns, error=error)
+
+
+def requests_response_hook(response, *args, **kwargs):
+    """ A requests response hook recording the call, up to its response headers, as a span. """
+    end_ns = time.time_ns()
+    record_http(response.request.method, response.request.url, response.status_code,
+                end_ns - int(response.elapsed.total_seconds() * 1e9), end_ns)
+
+
+def _on_httpx_request(request):
+    request.extensions["trace_start_ns"] = time.time_ns()
+
+
+def _on_httpx_response(response):
+    request = response.request
+    record_http(request.method, request.url, response.status_code,
+                request.extensions.get("trace_start_ns", time.time_ns()))
+
+
+async def _on_httpx_request_async(request):
+    _on_httpx_request(request)
+
+
+async def _on_httpx_response_async(response):
+    _on_httpx_response(response)
+
+
+def httpx_event_hooks(asynchronous=False):
+    """ Returns event hooks for an httpx client recording each call, up to its response headers, as a span. """
+    if asynchronous:
+        return {"request": [_on_httpx_request_async], "response": [_on_httpx_response_async]}
+    return {"request": [_on_httpx_request], "response": [_on_httpx_response]}
+
+
+class LLMTracingHandler(BaseCallbackHandler):
+    """ A callback handler recording every LLM call as a span, with role, backend, model and token counts. """
+
+    def __init__(self):
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, serialized, metadata, prompt_chars):
+        if not TRACING_ENABLED or _current_span.get() is None:
+            return
+        metadata = metadata or {}
+        kwargs = (serialized or {}).get("kwargs", {})
+        llm_span = Span(f"llm {metadata.get('role', 'unknown')}", parent=_current_span.get(),
+                        **{"llm.role": metadata.get("role", "unknown"),
+                           "llm.backend": metadata.get("backend", "unknown"),
+                           "llm.model": metadata.get("model") or kwargs.get("model_name") or kwargs.get("model") or "unknown",
+                           "llm.prompt_chars": prompt_chars})
+        for key in ("endpoint", "port"):
+            if metadata.get(key):
+                llm_span.set_attribute(f"llm.{key}", metadata[key])
+        with self._lock:
+            self._spans[run_id] = llm_span
+
+    def _finish(self, run_id):
+        with self._lock:
+            return self._spans.pop(run_id, None)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, serialized, metadata, sum(len(p) for p in prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, serialized, metadata, sum(len(str(m.content)) for batch in messages for m in batch))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        llm_span = self._finish(run_id)
+        if llm_span is None:
+            return
+        llm_span.set_attribute("llm.completion_chars", sum(len(g.text) for batch in response.generations for g in batch))
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                llm_span.set_attribute(f"llm.{kind}", usage[kind])
+        llm_span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        llm_span = self._finish(run_id)
+        if llm_span is not None:
+            llm_span.end(error=error)
+
+
+llm_handler = LLMTracingHandler()
+
+
+### Monitor tab
+
+
+def last_waterfall(width: int = 40):
+    """ Renders the most recent trace as a text waterfall, one span per line. """
+    spans = recent_traces.last()
+    if not spans:
+        return "No traces recorded yet."
+    start = min(s.start_ns for s in spans)
+    total = max(max(s.end_ns for s in spans) - start, 1)
+    children = {}
+    for s in sorted(spans, key=lambda s: s.start_ns):
+        children.setdefault(s.parent_id, []).append(s)
+    span_ids = {s.span_id for s in spans}
+    lines = []
+
+    def _render(s, depth):
+        offset = int((s.start_ns - start) / total * width)
+        length = max(1, int((s.end_ns - s.start_ns) / total * width))
+        bar = " " * offset + "#" * min(length, width - offset)
+        label = ("  " * depth + s.name)[:36]
+        lines.append(f"{label:<36} |{bar:<{width}}| {(s.end_ns - s.start_ns) / 1e6:9.1f} ms{' ERROR' if s.error else ''}")
+        for child in children.get(s.span_id, []):
+            _render(child, depth + 1)
+
+    # Roots are spans whose parent is not part of this trace (normally just the request span)
+    for s in sorted(spans, key=lambda s: s.start_ns):
+        if s.parent_id is None or s.parent_id not in span_ids:
+            _render(s, 0)
+    return "\n".join(lines)
@@ -0,0 +1,182 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from chatui import ollama
+from chatui.utils import database, graph, reranker, router
+
+"""
+Preloads the LLM backends and embedding models so the first question does not pay model load time.
+
+Every backend serving a role is sent one tiny request (Ollama models are loaded with keep_alive instead),
+and the embedding models embed a short string. The outcome and warm latency of each is kept so the app
+can report readiness, e.g. to a load balancer. Failed startup warmups are retried with exponential backoff
+until they succeed, so a transient error does not keep the app unready.
+"""
+
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_POOL_SIZE = int(os.environ.get("WARMUP_POOL_SIZE", "8"))
+WARMUP_RETRY_DELAY = float(os.environ.get("WARMUP_RETRY_DELAY", "10"))
+WARMUP_RETRY_MAX_DELAY = float(os.environ.get("WARMUP_RETRY_MAX_DELAY", "300"))
+
+""" Backends warmed at startup, before anyone has configured the app. Defaults to the UI's default API model. """
+
+WARMUP_API_MODELS = [m for m in os.environ.get("WARMUP_API_MODELS", "meta/llama3-70b-instruct").split(",") if m]
+WARMUP_OLLAMA_SERVER = os.environ.get("WARMUP_OLLAMA_SERVER", "")
+WARMUP_OLLAMA_PORT = os.environ.get("WARMUP_OLLAMA_PORT", "11434")
+WARMUP_OLLAMA_MODELS = [m for m in os.environ.get("WARMUP_OLLAMA_MODELS", "").split(",") if m]
+
+_lock = threading.Lock()
+_status = {}
+_pending = 0
+_retrying = set()
+_started = False
+
+
+def _name(target):
+    backend, endpoint, port, model = target
+    return f"{backend}:{endpoint}:{port}/{model}" if endpoint else f"{backend}/{model}"
+
+
+def _warm_llm(target):
+    backend, endpoint, port, model = target
+    if backend == "ollama":
+        ollama.OllamaChatModel(ollama_server=endpoint, ollama_port=port, model_name=model).preload()
+    else:
+        graph._build_llm(backend, endpoint, port, model, graph.TEMPERATURE).invoke("Hi", max_tokens=1)
+
+
+def _warm_text_embedder():
+    database.get_text_embedder().embed_query("warmup")
+
+
+def _warm_image_embedder():
+    database.get_image_embedder().embed_query("warmup")
+
+
+def _warm_reranker():
+    reranker.get_model().predict([("warmup", "warmup")], show_progress_bar=False)
+
+
+def _run(name, gating, fn, *args):
+    start = time.monotonic()
+    try:
+        fn(*args)
+        result = {"ready": True, "latency": round(time.monotonic() - start, 3)}
+    except Exception as e:
+        result = {"ready": False, "latency": round(time.monotonic() - start, 3), "error": str(e)}
+    print(f"---WARMUP {name}: {'READY' if result['ready'] else 'FAILED'} IN {result['latency']}s---")
+    if gating:
+        with _lock:
+            _status[name] = result
+    return name, result
+
+
+def _schedule_retry(jobs, delay):
+    with _lock:
+        jobs = [job for job in jobs if job[0] not in _retrying]
+        _retrying.update(job[0] for job in jobs)
+    if not jobs:
+        return
+    print(f"---WARMUP RETRYING {len(jobs)} FAILED IN {delay}s---")
+    timer = threading.Timer(delay, _retry, args=(jobs, delay))
+    timer.daemon = True
+    timer.start()
+
+
+def _retry(jobs, delay):
+    failed = [job for job in jobs if not _run(job[0], True, *job[1:])[1]["ready"]]
+    with _lock:
+        _retrying.difference_update(job[0] for job in jobs)
+    if failed:
+        _schedule_retry(failed, min(delay * 2, WARMUP_RETRY_MAX_DELAY))
+
+
+def default_targets():
+    """ Returns the (backend, endpoint, port, model) tuples to warm at startup. """
+    targets = [("api", "", "", model) for model in WARMUP_API_MODELS]
+    if WARMUP_OLLAMA_SERVER:
+        targets += [("ollama", WARMUP_OLLAMA_SERVER, WARMUP_OLLAMA_PORT, model) for model in WARMUP_OLLAMA_MODELS]
+    return targets
+
+
+def warmup(targets, embedders=True, gating=True):
+    """
+    Warms the given LLM backends, and optionally the embedding models, concurrently.
+
+    Args:
+        targets: (backend, endpoint, port, model) tuples, as returned by graph.resolve_backend
+        embedders (bool): Whether to also warm the text and image embedding models, train the fast router, and load the reranker if enabled
+        gating (bool): Whether the outcome counts towards readiness, and failures are retried; off for warmups triggered by users
+
+    Returns:
+        dict: Readiness and warm latency in seconds per backend
+    """
+    global _pending
+    jobs = [(_name(target), _warm_llm, target) for target in dict.fromkeys(targets)]
+    if embedders:
+        jobs += [("embedder/NV-Embed-QA", _warm_text_embedder), ("embedder/nvidia/nvclip", _warm_image_embedder),
+                 ("router/exemplars", router.train)]
+        if reranker.enabled():
+            jobs.append((f"reranker/{reranker.RERANK_MODEL}", _warm_reranker))
+    if gating:
+        with _lock:
+            _pending += 1
+            for job in jobs:
+                _status.setdefault(job[0], {"ready": False, "latency": None})
+    try:
+        with ThreadPoolExecutor(max_workers=WARMUP_POOL_SIZE, thread_name_prefix="warmup") as pool:
+            results = dict(pool.map(lambda job: _run(job[0], gating, *job[1:]), jobs))
+        if gating:
+            _schedule_retry([job for job in jobs if not results[job[0]]["ready"]], WARMUP_RETRY_DELAY)
+        return results
+    finally:
+        if gating:
+            with _lock:
+                _pending -= 1
+
+
+def start_background_warmup(targets=None, embedders=True, gating=True):
+    """ Runs warmup() on a daemon thread; defaults to the startup targets, which are only ever warmed once. """
+    global _started
+    if not WARMUP_ENABLED:
+        return
+    if targets is None:
+        with _lock:
+            if _started:
+                return
+            _started = True
+        targets = default_targets()
+    threading.Thread(target=warmup, args=(targets, embedders, gating), daemon=True, name="warmup").start()
+
+
+def readiness():
+    """
+    Reports whether the app is ready to serve.
+
+    Returns:
+        (bool, dict): Ready once a warmup has finished, none is in flight and every warmed backend responded, plus the per-backend report
+    """
+    with _lock:
+        report = {name: dict(result) for name, result in _status.items()}
+        warming = _pending > 0
+    # Nothing warmed yet means not ready, unless warmup is disabled altogether
+    ready = not warming and (bool(report) or not WARMUP_ENABLED) and all(result["ready"] for result in report.values())
+    return ready, {"ready": ready, "warming": warming, "backends": report}
@@ -27,7 +27,7 @@ import sys
 
 from chatui import assets, chat_client
 from chatui.prompts import prompts_llama3, prompts_mistral, defaults
-from chatui.utils import compile, database, logger, nim
+from chatui.utils import compile, database, graph, logger, nim
 
 from langgraph.graph import END, StateGraph
 
@@ -1308,41 +1308,41 @@ def build_page(client: chat_client.ChatClient) -> gr.Blocks:
             chat_history: List[Tuple[str, str]],
         ) -> Any:
 
-            inputs = {"question": question, 
-                      "generator_model_id": model_generator, 
-                      "router_model_id": model_router, 
-                      "retrieval_model_id": model_retrieval, 
-                      "hallucination_model_id": model_hallucination, 
-                      "answer_model_id": model_answer, 
-                      "prompt_generator": prompt_generator, 
-                      "prompt_router": prompt_router, 
-                      "prompt_retrieval": prompt_retrieval, 
-                      "prompt_hallucination": prompt_hallucination, 
-                      "prompt_answer": prompt_answer, 
-                      "router_use_nim": router_use_nim, 
-                      "retrieval_use_nim": retrieval_use_nim, 
-                      "generator_use_nim": generator_use_nim, 
-                      "hallucination_use_nim": hallucination_use_nim, 
-                      "nim_generator_ip": nim_generator_ip,
-                      "nim_router_ip": nim_router_ip,
-                      "nim_retrieval_ip": nim_retrieval_ip,
-                      "nim_hallucination_ip": nim_hallucination_ip,
-                      "nim_answer_ip": nim_answer_ip,
-                      "nim_generator_port": nim_generator_port,
-                      "nim_router_port": nim_router_port,
-                      "nim_retrieval_port": nim_retrieval_port,
-                      "nim_hallucination_port": nim_hallucination_port,
-                      "nim_answer_port": nim_answer_port,
-                      "nim_generator_id": nim_generator_id,
-                      "nim_router_id": nim_router_id,
-                      "nim_retrieval_id": nim_retrieval_id,
-                      "nim_hallucination_id": nim_hallucination_id,
-                      "nim_answer_id": nim_answer_id,
-                      "use_ollama": use_ollama,
-                      "ollama_server": ollama_server,
-                      "ollama_port": ollama_port,
-                      "ollama_model": ollama_model,
-                      "answer_use_nim": answer_use_nim}
+            settings = {"generator_model_id": model_generator, 
+                        "router_model_id": model_router, 
+                        "retrieval_model_id": model_retrieval, 
+                        "hallucination_model_id": model_hallucination, 
+                        "answer_model_id": model_answer, 
+                        "prompt_generator": prompt_generator, 
+                        "prompt_router": prompt_router, 
+                        "prompt_retrieval": prompt_retrieval, 
+                        "prompt_hallucination": prompt_hallucination, 
+                        "prompt_answer": prompt_answer, 
+                        "router_use_nim": router_use_nim, 
+                        "retrieval_use_nim": retrieval_use_nim, 
+                        "generator_use_nim": generator_use_nim, 
+                        "hallucination_use_nim": hallucination_use_nim, 
+                        "nim_generator_ip": nim_generator_ip,
+                        "nim_router_ip": nim_router_ip,
+                        "nim_retrieval_ip": nim_retrieval_ip,
+                        "nim_hallucination_ip": nim_hallucination_ip,
+                        "nim_answer_ip": nim_answer_ip,
+                        "nim_generator_port": nim_generator_port,
+                        "nim_router_port": nim_router_port,
+                        "nim_retrieval_port": nim_retrieval_port,
+                        "nim_hallucination_port": nim_hallucination_port,
+                        "nim_answer_port": nim_answer_port,
+                        "nim_generator_id": nim_generator_id,
+                        "nim_router_id": nim_router_id,
+                        "nim_retrieval_id": nim_retrieval_id,
+                        "nim_hallucination_id": nim_hallucination_id,
+                        "nim_answer_id": nim_answer_id,
+                        "use_ollama": use_ollama,
+                        "ollama_server": ollama_server,
+                        "ollama_port": ollama_port,
+                        "ollama_model": ollama_model,
+                        "answer_use_nim": answer_use_nim}
+            inputs = {"question": question, "config": graph.RunConfig.from_settings(settings)}
             
             if not valid_input(question):
                 yield "", chat_history + [[str(question), "*** ERR: Unable to process query. Query cannot be empty. ***"]], gr.update(show_label=False)